@@ -7,6 +7,7 @@ import ipaddress
 import os
 import base64
 import re
+import time
 
 # ─────────────────────────────────────────────────────────────────────────────
 # Imports that work both when this file is imported as a top-level module
@@ -308,24 +309,41 @@ def get_dns_ip() -> str:
     return "1.1.1.1"
 
 
+# External IP is effectively constant for the process lifetime; curl ifconfig.me
+# costs a docker exec plus an outbound HTTP round-trip, so keep a successful
+# answer for an hour. Failures are not cached.
+EXTERNAL_HOST_TTL_SEC = float(os.getenv("AWG_EXTERNAL_HOST_TTL_SEC", "3600"))
+_external_host_cache: Tuple[str, float] = ("", 0.0)
+
+
 def _detect_external_host_fallback() -> str:
-    """Best-effort external host detection inside AWG container."""
-    try:
-        rc, out, _ = _sh("curl -fsS ifconfig.me 2>/dev/null || true", timeout=10)
-        cand = (out or "").strip()
-        if cand and cand.count(".") == 3:
-            return cand
-    except Exception:
-        pass
+    """Best-effort external host detection inside AWG container (cached, see above)."""
+    global _external_host_cache
+    host, expires = _external_host_cache
+    if host and time.monotonic() < expires:
+        return host
+    host = _detect_external_host_uncached()
+    if host:
+        _external_host_cache = (host, time.monotonic() + EXTERNAL_HOST_TTL_SEC)
+    return host
+
+
+def _detect_external_host_uncached() -> str:
+    # One exec for both strategies; the awk/tr post-processing is done in Python.
+    # curl output goes first, hostname -I (local addresses) after the marker.
     try:
         rc, out, _ = _sh(
-            "hostname -I 2>/dev/null | awk '{print $1}' || true", timeout=5
+            "curl -fsS --max-time 8 ifconfig.me 2>/dev/null; echo; echo @@HOST@@; "
+            "hostname -I 2>/dev/null || true",
+            timeout=12,
         )
-        cand = (out or "").strip()
-        if cand and cand.count(".") == 3:
-            return cand
     except Exception:
-        pass
+        return ""
+    ext, _, local = (out or "").partition("@@HOST@@")
+    for chunk in (ext, local):
+        cand = next(iter(chunk.split()), "")
+        if _IPV4_RE.match(cand):
+            return cand
     return ""
 
 
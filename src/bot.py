@@ -3,7 +3,7 @@ from __future__ import annotations
 import os, io, json, re, uuid, base64, zlib, threading, time, subprocess, shlex, qrcode, logging
 from datetime import datetime, UTC
 from functools import wraps
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, Iterator, List, Optional
 from pathlib import Path
 
 # --- загрузка secret.env ДО любых импортов util/xray/awg и ДО чтения TOKEN ---
@@ -96,7 +96,7 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
-from services.util import XRAY_CONNECT_HOST, AWG_CONNECT_HOST
+from services.util import XRAY_CONNECT_HOST, AWG_CONNECT_HOST, json_dumps_compact
 from features.status.render import render_status_full, build_status_kb
 from features.admin.users import (
     show_admin_user_list,
@@ -136,7 +136,7 @@ from core.state import (
     STATE_PATH,
     HEARTBEAT_PATH,
     load_state,
-    save_state,
+    save_state_async,
     ensure_user_bucket,
     now_iso,
 )
@@ -292,6 +292,11 @@ def profiles_active(user: Dict[str, Any]) -> List[Dict[str, Any]]:
     return [p for p in user.get("profiles", []) if not p.get("deleted")]
 
 
+def iter_profiles_active(user: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Как profiles_active, но лениво — для поиска первого совпадения через next/any."""
+    return (p for p in user.get("profiles", []) if not p.get("deleted"))
+
+
 def profiles_active_by_type(user: Dict[str, Any], typ: str) -> List[Dict[str, Any]]:
     return [p for p in profiles_active(user) if p.get("type") == typ]
 
@@ -325,7 +330,7 @@ def xray_profile_status_for_user(
         pr = next(
             (
                 p
-                for p in profiles_active(user_rec)
+                for p in iter_profiles_active(user_rec)
                 if p.get("name") == pname and p.get("type") == "xray"
             ),
             None,
@@ -347,8 +352,19 @@ def xray_profile_status_for_user(
         return ("absent", "Отсутствует ⚠️")
 
 
+# всё, кроме [A-Za-z0-9._-], → "_": таблица для str.translate по ASCII;
+# не-ASCII символы сначала становятся "?" (по одному на символ), затем тоже "_"
+_NAME_ALLOWED = frozenset(
+    "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789._-"
+)
+_NAME_TRANS = str.maketrans({chr(i): "_" for i in range(128) if chr(i) not in _NAME_ALLOWED})
+
+
 def sanitize_name(name: str) -> str:
-    return re.sub(r"[^A-Za-z0-9._-]", "_", (name or "").strip())
+    s = (name or "").strip()
+    if not s.isascii():
+        s = s.encode("ascii", "replace").decode("ascii")
+    return s.translate(_NAME_TRANS)
 
 
 def _qr_png_bytes(text: str) -> bytes:
@@ -473,48 +489,50 @@ def _sync_collect_probe() -> dict:
     user_count = 0
 
     users = st.get("users", {}) if isinstance(st, dict) else {}
-    for tid_str, rec in users.items():
-        try:
-            tid = int(tid_str)
-        except Exception:
-            continue
-        user_count += 1
-        uname = rec.get("username") or ""
-        for p in _iter_xray_profiles(rec):
-            pname = p.get("name") or "-"
-            is_susp = bool(p.get("suspended"))
-            # Проверяем наличие в Xray только если профиль не отмечен как удалён
-            present = False
+    # одно чтение clientsTable на весь обход, а не stat-exec на каждый find_user
+    with XR.xray_batch():
+        for tid_str, rec in users.items():
             try:
-                present = bool(XR.find_user(tid, pname))
+                tid = int(tid_str)
             except Exception:
+                continue
+            user_count += 1
+            uname = rec.get("username") or ""
+            for p in _iter_xray_profiles(rec):
+                pname = p.get("name") or "-"
+                is_susp = bool(p.get("suspended"))
+                # Проверяем наличие в Xray только если профиль не отмечен как удалён
                 present = False
+                try:
+                    present = bool(XR.find_user(tid, pname))
+                except Exception:
+                    present = False
 
-            if is_susp:
-                status = "suspended"
-                label = "Приостановлен ⏸"
-                t_susp += 1
-            else:
-                if present:
-                    status = "active"
-                    label = "Активен ▶️"
-                    t_active += 1
+                if is_susp:
+                    status = "suspended"
+                    label = "Приостановлен ⏸"
+                    t_susp += 1
                 else:
-                    status = "absent"
-                    label = "Отсутствует ⚠️"
-                    t_absent += 1
+                    if present:
+                        status = "active"
+                        label = "Активен ▶️"
+                        t_active += 1
+                    else:
+                        status = "absent"
+                        label = "Отсутствует ⚠️"
+                        t_absent += 1
 
-            rows.append(
-                {
-                    "tid": tid,
-                    "username": uname,
-                    "name": pname,
-                    "suspended": is_susp,
-                    "present": present,
-                    "status": status,
-                    "label": label,
-                }
-            )
+                rows.append(
+                    {
+                        "tid": tid,
+                        "username": uname,
+                        "name": pname,
+                        "suspended": is_susp,
+                        "present": present,
+                        "status": status,
+                        "label": label,
+                    }
+                )
 
     probe = {
         "ts": now_iso(),
@@ -612,6 +630,7 @@ async def _sync_show(update: Update, context: ContextTypes.DEFAULT_TYPE, page: i
 
 
 # ========= ОБОЛОЧКИ ДЛЯ КЛЮЧЕЙ AMNEZIA (vpn://) =========
+
 def b64url_nopad(b: bytes) -> str:
     return base64.urlsafe_b64encode(b).decode("ascii").rstrip("=")
 
@@ -637,7 +656,7 @@ def build_amnezia_wrapper_json(
         "hostName": host,
         "nameOverriddenByUser": True,
     }
-    return json.dumps(wrapper, ensure_ascii=False, separators=(",", ":"))
+    return json_dumps_compact(wrapper)
 
 
 def make_vpn_url_from_json_str(wrapper_json: str) -> str:
@@ -711,7 +730,7 @@ async def show_menu(
     st = load_state()
     u = update.effective_user
     user = ensure_user_bucket(st, u.id, u.username or "", u.first_name or "")
-    save_state(st)
+    await save_state_async(st)
 
     is_admin = is_admin_id(u.id)
     allowed = user.get("allowed", False) or is_admin
@@ -890,14 +909,14 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         st = load_state()
         u = update.effective_user
         user = ensure_user_bucket(st, u.id, u.username or "", u.first_name or "")
-        save_state(st)
+        await save_state_async(st)
         await show_menu(update, context, welcome=False, prefer_edit=False)
         return
 
     st = load_state()
     u = update.effective_user
     user = ensure_user_bucket(st, u.id, u.username or "", u.first_name or "")
-    save_state(st)
+    await save_state_async(st)
 
     if data == "req_access":
         if is_admin_id(u.id):
@@ -1018,7 +1037,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pr = next(
             (
                 p
-                for p in profiles_active(user)
+                for p in iter_profiles_active(user)
                 if p["name"] == pname and p["type"] == ptype
             ),
             None,
@@ -1034,14 +1053,15 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         if ptype == "xray":
-            # статус профиля
-            status, status_label = xray_profile_status_for_user(user, u.id, pname)
-            info = None
-            if status != "absent":
-                try:
-                    info = XR.find_user(u.id, pname)
-                except Exception:
-                    info = None
+            # статус профиля и данные — одно чтение clientsTable
+            with XR.xray_batch():
+                status, status_label = xray_profile_status_for_user(user, u.id, pname)
+                info = None
+                if status != "absent":
+                    try:
+                        info = XR.find_user(u.id, pname)
+                    except Exception:
+                        info = None
 
             lines = [f"<b>{pname}</b> · Xray"]
             if info:
@@ -1120,7 +1140,9 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("prof_get_vpn:"):
         pname = data.split(":", 1)[1]
-        prof = next((p for p in profiles_active(user) if p.get("name") == pname), None)
+        prof = next(
+            (p for p in iter_profiles_active(user) if p.get("name") == pname), None
+        )
         if not prof:
             await edit_or_send(
                 update,
@@ -1197,7 +1219,9 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if data.startswith("prof_get_uri:"):
         pname = data.split(":", 1)[1]
-        status_enum, status_label = xray_profile_status_for_user(user, u.id, pname)
+        with XR.xray_batch():
+            status_enum, status_label = xray_profile_status_for_user(user, u.id, pname)
+            info = XR.find_user(u.id, pname) if status_enum == "active" else None
         if status_enum != "active":
             await edit_or_send(
                 update,
@@ -1209,7 +1233,6 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode="HTML",
             )
             return
-        info = XR.find_user(u.id, pname)
         if not info:
             await edit_or_send(
                 update,
@@ -1256,7 +1279,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 prof = next(
                     (
                         p
-                        for p in profiles_active(user)
+                        for p in iter_profiles_active(user)
                         if p["name"] == pname and p["type"] in ("amneziawg", "awg")
                     ),
                     None,
@@ -1457,12 +1480,12 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         st = load_state()
         u = update.effective_user
         user = ensure_user_bucket(st, u.id, u.username or "", u.first_name or "")
-        save_state(st)
+        await save_state_async(st)
 
         pr = next(
             (
                 p
-                for p in profiles_active(user)
+                for p in iter_profiles_active(user)
                 if p.get("name") == pname and p.get("type") == "xray"
             ),
             None,
@@ -1485,7 +1508,9 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
 
         # ★ ПРОВЕРКА СТАТУСА: активен ли профиль на сервере Xray?
-        status_enum, status_label = xray_profile_status_for_user(user, u.id, pname)  # ★
+        with XR.xray_batch():
+            status_enum, status_label = xray_profile_status_for_user(user, u.id, pname)  # ★
+            info_x = XR.find_user(u.id, pname) if status_enum == "active" else None
         if status_enum != "active":  # ★
             await edit_or_send(  # ★
                 update,
@@ -1504,7 +1529,6 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )  # ★
             return  # ★
 
-        info_x = XR.find_user(u.id, pname)
         if not info_x:
             await edit_or_send(
                 update,
@@ -1595,7 +1619,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         tu["allowed"] = True
         tu["allowed_at"] = now_iso()
         tu["allowed_by"] = update.effective_user.id
-        save_state(st)
+        await save_state_async(st)
         await edit_or_send(
             update,
             context,
@@ -1657,7 +1681,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             urec["allowed"] = True
             urec["allowed_at"] = now_iso()
             urec["allowed_by"] = update.effective_user.id
-            save_state(st)
+            await save_state_async(st)
 
             _notify_user_simple(
                 context,
@@ -1673,7 +1697,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Запрещаем доступ + автоприостановка Xray
         urec["allowed"] = False
-        save_state(st)
+        await save_state_async(st)
 
         # Промежуточный лоудер в ТОЙ ЖЕ карточке
         await edit_or_send(
@@ -1686,7 +1710,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
         total, done, skipped = _auto_suspend_all_xray(st, int(tid))
-        save_state(st)
+        await save_state_async(st)
 
         _notify_user_simple(
             context,
@@ -1784,7 +1808,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pr = next(
             (
                 p
-                for p in profiles_active(urec)
+                for p in iter_profiles_active(urec)
                 if p.get("name") == pname and p.get("type") == "xray"
             ),
             None,
@@ -1800,7 +1824,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pr["suspended"] = True
             pr["susp_uuid"] = snap.get("uuid")
             pr["susp_flow"] = snap.get("flow")
-            save_state(st)
+            await save_state_async(st)
             await show_admin_profile_card(
                 update, context, tid, pname, "xray", note="Профиль приостановлен."
             )
@@ -1834,7 +1858,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         pr = next(
             (
                 p
-                for p in profiles_active(urec)
+                for p in iter_profiles_active(urec)
                 if p.get("name") == pname and p.get("type") == "xray"
             ),
             None,
@@ -1852,7 +1876,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if ok:
             pr["suspended"] = False
             pr["uuid"] = uuid
-            save_state(st)
+            await save_state_async(st)
             await show_admin_profile_card(
                 update, context, tid, pname, "xray", note="Профиль возобновлён."
             )
@@ -1900,7 +1924,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 skipped += 1
 
-        save_state(st)
+        await save_state_async(st)
         note = f"⏸ Приостановлено: {done} из {total}." + (
             f" Пропущено: {skipped}." if skipped else ""
         )
@@ -1952,7 +1976,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 skipped += 1
 
-        save_state(st)
+        await save_state_async(st)
         note = f"▶️ Возобновлено: {done} из {total}." + (
             f" Пропущено: {skipped}." if skipped else ""
         )
@@ -2103,7 +2127,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     st = load_state()
     u = update.effective_user
     user = ensure_user_bucket(st, u.id, u.username or "", u.first_name or "")
-    save_state(st)
+    await save_state_async(st)
 
     if user.get("allowed") and context.user_data.get("awaiting_name"):
         name_raw = update.message.text or ""
@@ -2138,7 +2162,8 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data.pop("awaiting_name", None)
             return
         if any(
-            p["name"] == name and not p.get("deleted") for p in profiles_active(user)
+            p["name"] == name and not p.get("deleted")
+            for p in iter_profiles_active(user)
         ):
             await update.message.reply_text(
                 "Конфигурация с таким именем уже существует. Введите другое имя."
@@ -2276,7 +2301,7 @@ async def cmd_allow(update: Update, context: ContextTypes.DEFAULT_TYPE):
     urec["allowed"] = True
     urec["allowed_at"] = now_iso()
     urec["allowed_by"] = update.effective_user.id
-    save_state(st)
+    await save_state_async(st)
     await update.message.reply_text(
         f"✅ Доступ выдан <code>{tid}</code>", parse_mode="HTML"
     )
@@ -2307,11 +2332,11 @@ async def cmd_revoke(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 1) запрет доступа
     urec["allowed"] = False
-    save_state(st)
+    await save_state_async(st)
 
     # 2) автоприостановка Xray-профилей
     total, done, skipped = _auto_suspend_all_xray(st, tid)
-    save_state(st)
+    await save_state_async(st)
 
     # 3) итоги админу
     msg_admin = (
@@ -2363,11 +2388,9 @@ async def cmd_health(update: Update, context: ContextTypes.DEFAULT_TYPE):
     statuses = {}
     if rc_ps == 0 and out_ps:
         for line in out_ps.splitlines():
-            try:
-                n, s = line.split("\t", 1)
+            n, sep, s = line.partition("\t")
+            if sep:
                 statuses[n] = s
-            except Exception:
-                pass
     need = (
         os.getenv(
             "HEALTH_REQUIRE_CONTAINERS", "amnezia-awg,amnezia-xray,amnezia-dns,awgbot"
@@ -2761,11 +2784,9 @@ def _parse_docker_ps() -> dict:
     res = {}
     if rc == 0 and out:
         for line in out.splitlines():
-            try:
-                n, s = line.split("\t", 1)
+            n, sep, s = line.partition("\t")
+            if sep:
                 res[n] = s
-            except Exception:
-                pass
     return res
 
 
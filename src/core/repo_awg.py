@@ -7,14 +7,16 @@ import ipaddress
 import uuid as uuidlib
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timezone
-import shlex
 import time
 
 from services.logger_setup import get_logger
 from services.util import (
     docker_exec,
+    docker_exec_batch,
     docker_read_file,
     docker_write_file_atomic,
+    json_dumps_pretty,
+    shq,
     AWG_CONTAINER,
     AWG_CONFIG_PATH,
 )
@@ -40,10 +42,14 @@ def _ctime_like() -> str:
     return datetime.now(timezone.utc).strftime("%a %b %d %H:%M:%S %Y")
 
 
-def _read_clients_table() -> List[Dict[str, Any]]:
-    """Чтение и нормализация clientsTable → всегда список {clientId,userData,addInfo}."""
+def _read_clients_table(txt: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Чтение и нормализация clientsTable → всегда список {clientId,userData,addInfo}.
+    txt — уже прочитанное содержимое (например, из docker_exec_batch).
+    """
     try:
-        txt = docker_read_file(AWG_CONTAINER, CLIENTS_TABLE)
+        if txt is None:
+            txt = docker_read_file(AWG_CONTAINER, CLIENTS_TABLE)
         raw = json.loads(txt) if txt.strip() else []
     except Exception:
         raw = []
@@ -88,7 +94,7 @@ def _read_clients_table() -> List[Dict[str, Any]]:
             docker_write_file_atomic(
                 AWG_CONTAINER,
                 CLIENTS_TABLE,
-                json.dumps(raw, ensure_ascii=False, indent=2),
+                json_dumps_pretty(raw),
             )
         except Exception as e:
             log.warning({"event": "awg_clientsTable_autofix_failed", "err": str(e)})
@@ -98,15 +104,19 @@ def _read_clients_table() -> List[Dict[str, Any]]:
 
 def _write_clients_table(items: List[Dict[str, Any]]) -> None:
     docker_write_file_atomic(
-        AWG_CONTAINER, CLIENTS_TABLE, json.dumps(items, ensure_ascii=False, indent=2)
+        AWG_CONTAINER, CLIENTS_TABLE, json_dumps_pretty(items)
     )
 
 
-def _wg_dump_allowed_map() -> Dict[str, str]:
-    rc, out, _ = docker_exec(
-        AWG_CONTAINER, ["sh", "-lc", "wg show wg0 dump 2>/dev/null || true"]
-    )
-    if rc != 0 or not out:
+_WG_DUMP_CMD = "wg show wg0 dump 2>/dev/null || true"
+
+
+def _wg_dump_allowed_map(out: Optional[str] = None) -> Dict[str, str]:
+    if out is None:
+        rc, out, _ = docker_exec(AWG_CONTAINER, ["sh", "-lc", _WG_DUMP_CMD])
+        if rc != 0:
+            return {}
+    if not out:
         return {}
     lines = out.strip().splitlines()
     if not lines:
@@ -119,10 +129,11 @@ def _wg_dump_allowed_map() -> Dict[str, str]:
     return m
 
 
+_WG_PUBKEY_CMD = "wg show wg0 public-key 2>/dev/null || true"
+
+
 def _get_server_pubkey() -> Optional[str]:
-    rc, out, err = docker_exec(
-        AWG_CONTAINER, ["sh", "-lc", "wg show wg0 public-key 2>/dev/null || true"]
-    )
+    rc, out, err = docker_exec(AWG_CONTAINER, ["sh", "-lc", _WG_PUBKEY_CMD])
     if rc == 0 and out.strip():
         return out.strip()
     return None
@@ -141,8 +152,12 @@ def _get_server_iface_privkey() -> Optional[str]:
 
 
 def list_profiles() -> List[dict]:
-    clients = _read_clients_table()
-    allowed_map = _wg_dump_allowed_map()
+    # clientsTable и wg dump — одним docker exec
+    rc, (tbl, dump), _ = docker_exec_batch(
+        AWG_CONTAINER, [f"cat {shq(CLIENTS_TABLE)}", _WG_DUMP_CMD]
+    )
+    clients = _read_clients_table(tbl[1] if tbl[0] == 0 else "")
+    allowed_map = _wg_dump_allowed_map(dump[1]) if dump[0] == 0 else {}
     profiles: List[Dict[str, Any]] = []
     for c in clients:
         cid = c.get("clientId", "")
@@ -168,24 +183,20 @@ def list_profiles() -> List[dict]:
     return profiles
 
 
-def _gen_wg_keypair() -> tuple[str, str]:
-    rc, priv, err = docker_exec(AWG_CONTAINER, ["sh", "-lc", "wg genkey"])
-    if rc != 0 or not (priv or "").strip():
-        raise RuntimeError(f"wg genkey failed: {err}")
-    priv = priv.strip()
-    quoted_priv = shlex.quote(priv)
-    cmd = f"sh -lc 'printf %s {quoted_priv} | wg pubkey'"
-    rc, pub, err = docker_exec(AWG_CONTAINER, cmd)
-    if rc != 0 or not (pub or "").strip():
-        raise RuntimeError(f"wg pubkey failed: {err}")
-    return priv, pub.strip()
-
-
-def _gen_psk() -> str:
-    rc, psk, err = docker_exec(AWG_CONTAINER, ["sh", "-lc", "wg genpsk"])
-    if rc != 0 or not psk.strip():
-        raise RuntimeError(f"wg genpsk failed: {err}")
-    return psk.strip()
+def _gen_wg_keys() -> tuple[str, str, str]:
+    """(priv, pub, psk) одним docker exec: genkey → pubkey → genpsk."""
+    rc, res, err = docker_exec_batch(
+        AWG_CONTAINER,
+        [
+            'K=$(wg genkey) && printf %s "$K"',
+            'printf %s "$K" | wg pubkey',
+            "wg genpsk",
+        ],
+    )
+    for what, (rc_i, out) in zip(("genkey", "pubkey", "genpsk"), res):
+        if rc_i != 0 or not out:
+            raise RuntimeError(f"wg {what} failed: {err}")
+    return res[0][1], res[1][1], res[2][1]
 
 
 def _get_next_ip(clients: List[Dict[str, Any]], subnet_cidr: str) -> str:
@@ -217,15 +228,17 @@ def _name_in_use_for_owner(owner_tid: int, name: str) -> bool:
     return False
 
 
-def facts() -> dict:
+def facts(conf_text: Optional[str] = None) -> dict:
     port = None
     subnet = None
     dns = None
     endpoint = None
-    try:
-        lines = docker_read_file(AWG_CONTAINER, AWG_CONFIG_PATH).splitlines()
-    except Exception:
-        lines = []
+    if conf_text is None:
+        try:
+            conf_text = docker_read_file(AWG_CONTAINER, AWG_CONFIG_PATH)
+        except Exception:
+            conf_text = ""
+    lines = conf_text.splitlines()
 
     for line in lines:
         l = line.strip()
@@ -258,9 +271,7 @@ def _apply_runtime_sync() -> None:
 
 
 def _wg_dump_has_pub(pubkey: str) -> bool:
-    rc, out, _ = docker_exec(
-        AWG_CONTAINER, ["sh", "-lc", "wg show wg0 dump 2>/dev/null || true"]
-    )
+    rc, out, _ = docker_exec(AWG_CONTAINER, ["sh", "-lc", _WG_DUMP_CMD])
     if rc != 0 or not out:
         return False
     for line in out.splitlines()[1:]:
@@ -317,8 +328,7 @@ def create_profile(profile_data: dict) -> str:
 
     clients = _read_clients_table()
     subnet = facts().get("subnet") or "10.8.0.0/24"
-    priv, pub = _gen_wg_keypair()
-    psk = _gen_psk()
+    priv, pub, psk = _gen_wg_keys()
     ip = _get_next_ip(clients, subnet)
 
     client_uuid = str(uuidlib.uuid4())
@@ -382,9 +392,12 @@ def render_client_config(uuid: str) -> str:
         raise ValueError("Profile not found")
     ud = prof["userData"]
 
-    # Параметры сервера
-    f = facts()
-    server_pub = _get_server_pubkey()
+    # Параметры сервера: wg0.conf и публичный ключ — одним docker exec
+    _, (conf, pubkey), _ = docker_exec_batch(
+        AWG_CONTAINER, [f"cat {shq(AWG_CONFIG_PATH)}", _WG_PUBKEY_CMD]
+    )
+    f = facts(conf[1] if conf[0] == 0 else "")
+    server_pub = pubkey[1] if pubkey[0] == 0 and pubkey[1] else None
     server_port = f.get("port")
     endpoint = f.get("endpoint")  # может быть None
     dns = f.get("dns")
@@ -3,15 +3,22 @@
 from __future__ import annotations
 
 import json
+import os
+import threading
 import uuid as uuidlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
 from typing import List, Dict, Any, Optional
 from datetime import datetime, timezone
 
 from services.logger_setup import get_logger
 from services.util import (
     docker_exec,
-    docker_read_file,
     docker_write_file_atomic,
+    host_path_for,
+    json_dumps_pretty,
+    shq,
     XRAY_CONTAINER,
 )
 
@@ -38,22 +45,174 @@ def _ctime_like() -> str:
     return datetime.now(timezone.utc).strftime("%a %b %d %H:%M:%S %Y")
 
 
+# Кэш содержимого файлов контейнера: (container, path) -> (подпись stat, текст).
+# Храним текст, а не разобранный объект: вызывающие мутируют результат,
+# а json.loads дешевле deepcopy.
+_text_cache: Dict[tuple, tuple] = {}
+_text_cache_lock = threading.Lock()
+# Подпись файла в контейнере: inode, размер, mtime с наносекундами
+_STAT_FMT = "%i %s %y"
+
+
+def _host_sig(hp: str) -> str:
+    st = os.stat(hp)
+    return f"{st.st_ino} {st.st_size} {st.st_mtime_ns}"
+
+
+def _read_text_cached(container: str, path: str) -> str:
+    """
+    Один docker exec: stat (inode/размер/mtime с наносекундами) и cat только
+    если подпись отличается от закэшированной.
+    """
+    key = (container, path)
+    with _text_cache_lock:
+        hit = _text_cache.get(key)
+    cached_sig = hit[0] if hit else ""
+    hp = host_path_for(container, path)
+    if hp:
+        # каталог смонтирован в бот: stat/чтение локально, без docker exec
+        sig = _host_sig(hp)
+        if hit and sig == cached_sig:
+            return hit[1]
+        with open(hp, encoding="utf-8") as f:
+            body = f.read().strip()
+        with _text_cache_lock:
+            _text_cache[key] = (sig, body)
+        return body
+    script = (
+        f"s=$(stat -c {shq(_STAT_FMT)} {shq(path)}) || exit 1; "
+        "printf '%s\\n' \"$s\"; "
+        f"[ \"$s\" = {shq(cached_sig)} ] || cat {shq(path)}"
+    )
+    rc, out, err = docker_exec(container, ["sh", "-lc", script])
+    if rc != 0:
+        raise RuntimeError(err or f"failed to read {path}")
+    sig, _, body = out.partition("\n")
+    if hit and sig == cached_sig:
+        return hit[1]
+    with _text_cache_lock:
+        _text_cache[key] = (sig, body)
+    return body
+
+
 def _read_json(container: str, path: str, default):
     try:
-        txt = docker_read_file(container, path)
+        txt = _read_text_cached(container, path)
         return json.loads(txt) if txt.strip() else default
     except Exception as e:
         log.warning({"msg": f"Failed to read JSON {path}: {e}"})
         return default
 
 
-def _write_json(container: str, path: str, obj) -> None:
-    docker_write_file_atomic(
-        container, path, json.dumps(obj, ensure_ascii=False, indent=2)
-    )
+# Производные только-для-чтения значения из JSON (например, порт из server.json):
+# (container, path, name) -> (подпись stat, значение). Пока файл не менялся,
+# весь JSON заново не разбираем.
+_derived_cache: Dict[tuple, tuple] = {}
+
+
+def _read_json_derived(container: str, path: str, name: str, fn, default):
+    try:
+        txt = _read_text_cached(container, path)
+    except Exception as e:
+        log.warning({"msg": f"Failed to read JSON {path}: {e}"})
+        return fn(default)
+    with _text_cache_lock:
+        hit = _text_cache.get((container, path))
+        sig = hit[0] if hit else None
+        cached = _derived_cache.get((container, path, name))
+    if sig is not None and cached is not None and cached[0] == sig:
+        return cached[1]
+    try:
+        obj = json.loads(txt) if txt.strip() else default
+    except Exception as e:
+        log.warning({"msg": f"Failed to read JSON {path}: {e}"})
+        obj = default
+    value = fn(obj)
+    if sig is not None:
+        with _text_cache_lock:
+            _derived_cache[(container, path, name)] = (sig, value)
+    return value
+
+
+def _write_json(container: str, path: str, obj, force: bool = False) -> bool:
+    """
+    Атомарная запись JSON. Нет изменений — нет записи: если новый текст совпадает
+    с закэшированным и файл с тех пор не менялся (stat), пропускаем.
+    force=True — писать всегда. Возвращает True, если запись была.
+    """
+    txt = json_dumps_pretty(obj)
+    key = (container, path)
+    if not force:
+        with _text_cache_lock:
+            hit = _text_cache.get(key)
+        # дешёвая проверка по кэшу; совпало — подтверждаем актуальность подписью stat
+        if hit is not None and hit[1] == txt.strip():
+            try:
+                if _read_text_cached(container, path) == txt.strip():
+                    log.debug({"event": "xray_write_skipped_nochange", "path": path})
+                    return False
+            except Exception:
+                pass
+    with _text_cache_lock:
+        _text_cache.pop(key, None)
+    sig = docker_write_file_atomic(container, path, txt, stat_fmt=_STAT_FMT)
+    # кэш — текст нашей же записи с подписью нового файла: следующее чтение
+    # (add -> find, пакет правок) обойдётся stat без cat. Подписи нет — просто сброс.
+    hp = host_path_for(container, path)
+    if hp:
+        try:
+            sig = _host_sig(hp)
+        except OSError:
+            sig = None
+    if sig:
+        with _text_cache_lock:
+            _text_cache[key] = (sig, txt.strip())
+    return True
+
+
+# Пакетный режим (xray_batch): clientsTable читается один раз, правки копятся
+# в памяти и пишутся одной записью на выходе. Состояние — в ContextVar, а не
+# threading.local: async-хендлеры делят поток event loop, но у каждой задачи
+# свой контекст, так что правки одного хендлера не попадут в запись другого.
+# {"items": [...], "dirty": bool, "index": (profiles, by_name, by_uuid) | None}
+_batch_var: ContextVar[Optional[Dict[str, Any]]] = ContextVar("xray_batch", default=None)
+
+
+@contextmanager
+def xray_batch():
+    """
+    Группа изменений clientsTable одной записью:
+        with xray_batch():
+            remove_user_by_name(...); add_user(...)
+    Внутри блока чтения видят уже сделанные правки. Вложенные блоки — no-op.
+    Запись — только при нормальном выходе: исключение в блоке отменяет все
+    его правки (ничего не пишется наполовину).
+    Годится и для серии чтений (проверка статуса + find_user): одно чтение
+    на блок вместо stat-exec на каждый вызов.
+    Блоки разных задач изолированы, но await внутри блока с правками делает
+    запись «последний побеждает» — держите такие блоки без await.
+    """
+    if _batch_var.get() is not None:
+        yield
+        return
+    batch = {"items": _read_clients_table(), "dirty": False, "index": None}
+    token = _batch_var.set(batch)
+    try:
+        yield
+    finally:
+        _batch_var.reset(token)
+    if batch["dirty"]:
+        _write_json(XRAY_CONTAINER, CLIENTS_TABLE, batch["items"])
+
+
+_UD_KEYS = frozenset(("clientName", "creationDate"))
+_AI_KEYS = frozenset(("type", "uuid", "owner_tid", "email", "created_at", "source", "notes"))
 
 
 def _read_clients_table() -> List[Dict[str, Any]]:
+    batch = _batch_var.get()
+    if batch is not None:
+        return batch["items"]
     raw = _read_json(XRAY_CONTAINER, CLIENTS_TABLE, [])
     if isinstance(raw, dict):
         # Защита от старого формата
@@ -65,7 +224,16 @@ def _read_clients_table() -> List[Dict[str, Any]]:
         raw = []
 
     changed = False
+    # метки времени для недостающих полей — одни на весь проход
+    ctime = now = None
+    ud_keys, ai_keys = _UD_KEYS, _AI_KEYS
     for it in raw:
+        ud = it.get("userData")
+        ai = it.get("addInfo")
+        # обычный случай: запись уже нормализована — проверка двумя операциями над множествами
+        if ud and ai and ud_keys <= ud.keys() and ai_keys <= ai.keys():
+            continue
+
         ud = it.setdefault("userData", {}) or {}
         ai = it.setdefault("addInfo", {}) or {}
         cid = it.get("clientId", "")
@@ -74,14 +242,17 @@ def _read_clients_table() -> List[Dict[str, Any]]:
             ud["clientName"] = f"XRAY-{str(cid)[:8]}"
             changed = True
         if "creationDate" not in ud:
-            ud["creationDate"] = _ctime_like()
+            ctime = ctime or _ctime_like()
+            ud["creationDate"] = ctime
             changed = True
 
         ai.setdefault("type", "xray")
         ai.setdefault("uuid", ai.get("uuid") or cid)
         ai.setdefault("owner_tid", None)
         ai.setdefault("email", ai.get("email"))
-        ai.setdefault("created_at", ai.get("created_at") or _now_iso())
+        if not ai.get("created_at"):
+            now = now or _now_iso()
+            ai.setdefault("created_at", now)
         ai.setdefault("source", "bot")
         ai.setdefault("notes", "")
         it["userData"] = ud
@@ -95,12 +266,15 @@ def _read_clients_table() -> List[Dict[str, Any]]:
     return raw
 
 
-def _write_clients_table(items: List[Dict[str, Any]]) -> None:
-    _write_json(XRAY_CONTAINER, CLIENTS_TABLE, items)
+def _write_clients_table(items: List[Dict[str, Any]], force: bool = False) -> None:
+    batch = _batch_var.get()
+    if batch is not None:
+        batch.update(items=items, dirty=True, index=None)
+        return
+    _write_json(XRAY_CONTAINER, CLIENTS_TABLE, items, force=force)
 
 
-def _listen_port() -> Optional[int]:
-    srv = _read_json(XRAY_CONTAINER, XRAY_SERVER_JSON, {})
+def _port_from_server(srv) -> Optional[int]:
     try:
         inb = (srv.get("inbounds") or [])[0]
         return int(inb.get("port"))
@@ -108,71 +282,125 @@ def _listen_port() -> Optional[int]:
         return None
 
 
+def _listen_port() -> Optional[int]:
+    return _read_json_derived(XRAY_CONTAINER, XRAY_SERVER_JSON, "port", _port_from_server, {})
+
+
 def facts() -> dict:
     return {"listen_port": _listen_port(), "count_profiles": len(_read_clients_table())}
 
 
+def _name_key(owner_tid, name: Optional[str]) -> tuple:
+    """Ключ профиля «владелец + имя без регистра» — один для индекса, поиска и удаления."""
+    return (owner_tid, (name or "").strip().lower())
+
+
+def _profile_view(it: Dict[str, Any]) -> Dict[str, Any]:
+    """Запись clientsTable → профиль бота; userData/addInfo разбираем один раз."""
+    cid = it.get("clientId", "")
+    ud = it.get("userData", {}) or {}
+    ai = it.get("addInfo", {}) or {}
+    return {
+        "uuid": ai.get("uuid") or cid,
+        "clientId": cid,
+        "name": ud.get("clientName"),
+        "owner_tid": ai.get("owner_tid"),
+        "userData": ud,
+        "addInfo": ai,
+    }
+
+
 def list_profiles() -> List[dict]:
-    items = _read_clients_table()
-    out: List[Dict[str, Any]] = []
-    for it in items:
-        cid = it.get("clientId", "")
-        ud = it.get("userData", {}) or {}
-        ai = it.get("addInfo", {}) or {}
-        out.append(
-            {
-                "uuid": ai.get("uuid") or cid,
-                "clientId": cid,
-                "name": ud.get("clientName"),
-                "owner_tid": ai.get("owner_tid"),
-                "userData": ud,
-                "addInfo": ai,
-            }
-        )
-    return out
+    return [_profile_view(it) for it in _read_clients_table()]
+
+
+# Индекс позиций в list_profiles() для текущей версии clientsTable (подпись stat из
+# _text_cache): {(owner_tid, name.strip().lower()): i} и {uuid: i}, первое вхождение.
+_index_cache: Dict[str, Any] = {"sig": None, "by_name": {}, "by_uuid": {}}
+
+
+def _build_index(profiles: List[dict]) -> tuple[dict, dict]:
+    by_name: Dict[tuple, int] = {}
+    by_uuid: Dict[str, int] = {}
+    for i, p in enumerate(profiles):
+        by_name.setdefault(_name_key(p["owner_tid"], p["name"]), i)
+        by_uuid.setdefault(p.get("uuid"), i)
+    return by_name, by_uuid
+
+
+def _profiles_indexed() -> tuple[List[dict], dict, dict]:
+    """
+    list_profiles() + индексы. Индекс пересобирается только при смене версии
+    clientsTable; внутри xray_batch — до первой записи в блоке.
+    """
+    batch = _batch_var.get()
+    if batch is not None:
+        if batch["index"] is None:
+            profiles = list_profiles()
+            batch["index"] = (profiles, *_build_index(profiles))
+        return batch["index"]
+    profiles = list_profiles()
+    with _text_cache_lock:
+        hit = _text_cache.get((XRAY_CONTAINER, CLIENTS_TABLE))
+    sig = hit[0] if hit else None
+    if sig is not None and _index_cache["sig"] == sig:
+        return profiles, _index_cache["by_name"], _index_cache["by_uuid"]
+    by_name, by_uuid = _build_index(profiles)
+    if sig is not None:
+        _index_cache.update(sig=sig, by_name=by_name, by_uuid=by_uuid)
+    return profiles, by_name, by_uuid
+
+
+def _find_by_name(owner_tid, name_norm: str) -> Optional[dict]:
+    profiles, by_name, _ = _profiles_indexed()
+    key = (owner_tid, name_norm)
+    i = by_name.get(key)
+    if i is None:
+        return None
+    if i < len(profiles) and _name_key(profiles[i]["owner_tid"], profiles[i]["name"]) == key:
+        return profiles[i]
+    # позиция не совпала — индекс устарел (гонка с записью), проверяем перебором
+    return next((p for p in profiles if _name_key(p["owner_tid"], p["name"]) == key), None)
 
 
 def _name_in_use_for_owner(owner_tid: int, name: str) -> bool:
     if not name:
         return False
     name_norm = " ".join(name.split()).lower()
-    for p in list_profiles():
-        if p.get("owner_tid") != owner_tid:
-            continue
-        if (p.get("name") or "").strip().lower() == name_norm:
-            return True
-    return False
+    return _find_by_name(owner_tid, name_norm) is not None
 
 
 def add_user(tg_id: int, name: str) -> Dict[str, Any]:
     name = (name or "").strip()
-    if _name_in_use_for_owner(int(tg_id), name):
-        raise ValueError(f"Имя «{name}» уже занято среди ваших XRAY-профилей")
-
-    items = _read_clients_table()
-    new_uuid = str(uuidlib.uuid4())
-    client_id = new_uuid  # для XRAY clientId == uuid
-
-    record = {
-        "clientId": client_id,
-        "userData": {
-            "clientName": (name or f"XRAY-{new_uuid[:8]}"),
-            "creationDate": _ctime_like(),
-        },
-        "addInfo": {
-            "type": "xray",
-            "uuid": new_uuid,
-            "owner_tid": int(tg_id),
-            "email": f"{int(tg_id)}-{(name or '').strip().replace(' ', '_')}",
-            "created_at": _now_iso(),
-            # Полей deleted/deleted_at больше не используем — храним только живые записи.
-            "source": "bot",
-            "notes": "",
-        },
-    }
-
-    items.append(record)
-    _write_clients_table(items)
+    # проверка имени и дозапись — на одном чтении clientsTable
+    with xray_batch():
+        if _name_in_use_for_owner(int(tg_id), name):
+            raise ValueError(f"Имя «{name}» уже занято среди ваших XRAY-профилей")
+
+        items = _read_clients_table()
+        new_uuid = str(uuidlib.uuid4())
+        client_id = new_uuid  # для XRAY clientId == uuid
+
+        record = {
+            "clientId": client_id,
+            "userData": {
+                "clientName": (name or f"XRAY-{new_uuid[:8]}"),
+                "creationDate": _ctime_like(),
+            },
+            "addInfo": {
+                "type": "xray",
+                "uuid": new_uuid,
+                "owner_tid": int(tg_id),
+                "email": f"{int(tg_id)}-{(name or '').strip().replace(' ', '_')}",
+                "created_at": _now_iso(),
+                # Полей deleted/deleted_at больше не используем — храним только живые записи.
+                "source": "bot",
+                "notes": "",
+            },
+        }
+
+        items.append(record)
+        _write_clients_table(items)
     return {
         "uuid": new_uuid,
         "clientId": client_id,
@@ -183,38 +411,44 @@ def add_user(tg_id: int, name: str) -> Dict[str, Any]:
 
 
 def find_user(tg_id: int, name: str) -> Optional[dict]:
-    name_norm = (name or "").strip().lower()
-    for p in list_profiles():
-        if p.get("owner_tid") != int(tg_id):
-            continue
-        if (p.get("name") or "").strip().lower() == name_norm:
-            return p
-    return None
+    return _find_by_name(int(tg_id), (name or "").strip().lower())
 
 
-def remove_user_by_name(tg_id: int, name: str) -> bool:
-    name_norm = (name or "").strip().lower()
-    items = _read_clients_table()
-    new_items = []
+def _drop_items(items: List[Dict[str, Any]], pred) -> bool:
+    """Удаляет из items на месте все записи с pred(it); копию списка не строим."""
     changed = False
-    for it in items:
-        ai = it.get("addInfo", {}) or {}
-        ud = it.get("userData", {}) or {}
-        if (
-            ai.get("owner_tid") == int(tg_id)
-            and (ud.get("clientName") or "").strip().lower() == name_norm
-        ):
+    for i in range(len(items) - 1, -1, -1):
+        if pred(items[i]):
+            del items[i]
             changed = True
-            continue  # физическое удаление
-        new_items.append(it)
+    return changed
+
+
+def remove_user_by_name(tg_id: int, name: str) -> bool:
+    key = _name_key(int(tg_id), name)
+    items = _read_clients_table()
+    # физическое удаление
+    changed = _drop_items(
+        items,
+        lambda it: _name_key(
+            (it.get("addInfo") or {}).get("owner_tid"),
+            (it.get("userData") or {}).get("clientName"),
+        ) == key,
+    )
     if changed:
-        _write_clients_table(new_items)
+        _write_clients_table(items)
     return changed
 
 
 # Совместимость для бота
 def find_profile_by_uuid(uuid_str: str) -> Optional[dict]:
-    return next((p for p in list_profiles() if p.get("uuid") == uuid_str), None)
+    profiles, _, by_uuid = _profiles_indexed()
+    i = by_uuid.get(uuid_str)
+    if i is None:
+        return None
+    if i < len(profiles) and profiles[i].get("uuid") == uuid_str:
+        return profiles[i]
+    return next((p for p in profiles if p.get("uuid") == uuid_str), None)
 
 
 def create_profile(d: dict) -> str:
@@ -225,16 +459,9 @@ def create_profile(d: dict) -> str:
 def delete_profile_by_uuid(_uuid: str) -> bool:
     # Удаление по uuid
     items = _read_clients_table()
-    new_items = []
-    changed = False
-    for it in items:
-        ai = it.get("addInfo", {}) or {}
-        if ai.get("uuid") == _uuid:
-            changed = True
-            continue
-        new_items.append(it)
+    changed = _drop_items(items, lambda it: (it.get("addInfo") or {}).get("uuid") == _uuid)
     if changed:
-        _write_clients_table(new_items)
+        _write_clients_table(items)
     return changed
 
 
@@ -247,15 +474,24 @@ def render_client_config(uuid: str) -> str:
     if not prof:
         raise ValueError("Profile not found")
 
-    port = _listen_port()
     email = (prof.get("addInfo") or {}).get("email")
     cid = prof.get("clientId")
 
+    # общая часть зависит только от порта — подставляем лишь поля клиента
+    return (
+        _client_config_template(_listen_port() or 443)
+        .replace('"__EMAIL__"', json.dumps(email, ensure_ascii=False))
+        .replace('"__UID__"', json.dumps(cid, ensure_ascii=False))
+    )
+
+
+@lru_cache(maxsize=8)
+def _client_config_template(port: int) -> str:
     obj = {
         "protocol": "vless",
-        "uuid": cid,
-        "email": email,
-        "server": {"host": "<SERVER_HOST>", "port": port or 443},
+        "uuid": "__UID__",
+        "email": "__EMAIL__",
+        "server": {"host": "<SERVER_HOST>", "port": port},
         "transport": {"type": "tcp", "security": "tls"},
     }
     return json.dumps(obj, ensure_ascii=False, indent=2) + "\n"
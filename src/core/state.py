@@ -1,6 +1,7 @@
 # src/core/state.py
 from __future__ import annotations
-import os, json, time, hashlib
+import os, json, time, copy, asyncio, hashlib, tempfile, threading
+from collections import deque
 from datetime import datetime, UTC
 from pathlib import Path
 from typing import Dict, Any
@@ -16,6 +17,8 @@ logger = get_logger("core.state")
 DATA_DIR = "/app/data"
 STATE_PATH = os.path.join(DATA_DIR, "state.json")
 HEARTBEAT_PATH = os.path.join(DATA_DIR, "heartbeat")
+# Версия схемы state.json: при несовпадении load_state один раз мигрирует записи
+STATE_SCHEMA = 2
 
 STATE_BACKUPS_DIR = os.getenv("STATE_BACKUPS_DIR", "/app/data/backups")
 STATE_BACKUPS_KEEP = int(os.getenv("STATE_BACKUPS_KEEP", "20"))
@@ -24,6 +27,28 @@ STATE_BACKUP_MIN_INTERVAL_SEC = int(os.getenv("STATE_BACKUP_MIN_INTERVAL_SEC", "
 # Память для автобэкапов
 _last_state_backup_ts: float = 0.0
 _last_state_backup_fingerprint: str = ""
+_backup_deque: deque[Path] | None = None
+
+# Подпись последней записи state.json: (blake2b содержимого, mtime_ns, size) —
+# одинаковое содержимое повторно не пишем
+_last_write_sig: tuple[bytes, int, int] | None = None
+
+# Асинхронное сохранение (см. save_state_async): один писатель, серии слипаются
+_save_lock = asyncio.Lock()
+# (ревизия, снимок), ожидающий записи
+_pending_state: tuple[int, Dict[str, Any]] | None = None
+# Запись на диск — строго по одной (поток save_state_async и синхронный save_state);
+# ревизия последнего записанного снимка: более старый снимок поверх не пишем
+_write_lock = threading.Lock()
+_written_rev: int = 0
+# последний снимок, ещё не дошедший до диска, — его отдаёт load_state
+_unsaved_state: Dict[str, Any] | None = None
+# ревизия состояния: растёт на каждом save_state* (см. state_revision)
+_state_rev: int = 0
+
+# Отсортированные tid пользователей (см. get_sorted_tids)
+_sorted_tids_cache: tuple[str, ...] | None = None
+_sorted_tids_rev: tuple[int, int] | None = None
 
 
 def now_iso() -> str:
@@ -53,35 +78,48 @@ def _list_state_backups() -> list[Path]:
         return []
 
 
-def _rotate_state_backups() -> tuple[int, int]:
+def _backups_deque() -> deque[Path]:
     """
-    Оставляет только STATE_BACKUPS_KEEP последних бэкапов.
-    Возвращает (total_before, removed).
+    Очередь бэкапов (старые → новые), ограниченная STATE_BACKUPS_KEEP.
+    Каталог сканируется и сортируется один раз — при первом обращении;
+    лишние файлы, найденные при этом, удаляются.
     """
-    items = _list_state_backups()
-    total = len(items)
+    global _backup_deque
+    if _backup_deque is None:
+        keep = max(0, STATE_BACKUPS_KEEP)
+        items = _list_state_backups()  # newest first
+        for x in items[keep:]:
+            try:
+                x.unlink(missing_ok=True)
+            except Exception:
+                pass
+        _backup_deque = deque(reversed(items[:keep]), maxlen=keep)
+    return _backup_deque
+
+
+def _rotate_state_backups(new_path: Path) -> tuple[int, int]:
+    """
+    Добавляет свежий бэкап в очередь и удаляет вытесненный (O(1), без пересканирования).
+    Возвращает (total_after, removed).
+    """
+    dq = _backups_deque()
+    evicted: list[Path] = []
+    if dq and dq[-1] == new_path:
+        pass  # тот же файл перезаписан (бэкапы в одну секунду)
+    elif not dq.maxlen:
+        evicted.append(new_path)
+    else:
+        if len(dq) == dq.maxlen:
+            evicted.append(dq[0])
+        dq.append(new_path)
     removed = 0
-    try:
-        if total > STATE_BACKUPS_KEEP:
-            for x in items[STATE_BACKUPS_KEEP:]:
-                try:
-                    x.unlink(missing_ok=True)
-                    removed += 1
-                except Exception:
-                    pass
-    finally:
+    for x in evicted:
         try:
-            logger.info(
-                {
-                    "event": "state_backup_rotate",
-                    "total": total,
-                    "keep": STATE_BACKUPS_KEEP,
-                    "removed": removed,
-                }
-            )
+            x.unlink(missing_ok=True)
+            removed += 1
         except Exception:
             pass
-    return total, removed
+    return len(dq), removed
 
 
 def _auto_backup_state_json(state_obj: dict) -> None:
@@ -91,29 +129,33 @@ def _auto_backup_state_json(state_obj: dict) -> None:
     """
     global _last_state_backup_ts, _last_state_backup_fingerprint
     try:
+        # дешёвая проверка интервала — до сериализации и хэша
+        now = time.time()
+        if (now - _last_state_backup_ts) < max(0, STATE_BACKUP_MIN_INTERVAL_SEC):
+            return
         dump = json.dumps(
             state_obj, ensure_ascii=False, sort_keys=True, separators=(",", ":")
         )
         fp = hashlib.sha256(dump.encode("utf-8")).hexdigest()
         if fp == _last_state_backup_fingerprint:
             return
-        now = time.time()
-        if (now - _last_state_backup_ts) < max(0, STATE_BACKUP_MIN_INTERVAL_SEC):
-            return
 
         _ensure_dir(STATE_BACKUPS_DIR)
+        _backups_deque()  # скан каталога — до появления нового файла
         ts = _state_backup_timestamp()
         bpath = os.path.join(STATE_BACKUPS_DIR, f"state-{ts}.json")
-        with open(bpath, "w", encoding="utf-8") as f:
-            f.write(dump)
+        # state.json только что записан save_state: бэкап — жёсткая ссылка на него
+        # (без копирования данных; следующий os.replace создаст новый inode).
+        # Другая ФС (EXDEV) / файл уже есть / нет поддержки ссылок — пишем как раньше.
+        try:
+            os.link(STATE_PATH, bpath)
+        except OSError:
+            with open(bpath, "w", encoding="utf-8") as f:
+                f.write(dump)
 
         logger.info({"event": "state_backup_ok", "path": bpath})
 
-        total_before, removed = _rotate_state_backups()
-        try:
-            total_after = len(_list_state_backups())
-        except Exception:
-            total_after = total_before - removed
+        total_after, removed = _rotate_state_backups(Path(bpath))
         logger.info(
             {
                 "event": "state_backup_rotate",
@@ -130,12 +172,103 @@ def _auto_backup_state_json(state_obj: dict) -> None:
         logger.warning({"event": "state_backup_postsave_fail", "error": str(e)})
 
 
-def save_state(st: Dict[str, Any]) -> None:
-    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
-    tmp = STATE_PATH + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(st, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, STATE_PATH)
+def _write_all(fd: int, data: bytes) -> None:
+    view = memoryview(data)
+    while view:
+        n = os.write(fd, view)
+        view = view[n:]
+
+
+def _fsync_dir(path: str) -> None:
+    try:
+        dfd = os.open(path, os.O_DIRECTORY)
+    except OSError:
+        return
+    try:
+        os.fsync(dfd)
+    except OSError:
+        pass
+    finally:
+        os.close(dfd)
+
+
+def profile_map(urec: Dict[str, Any]) -> Dict[tuple, Dict[str, Any]]:
+    """
+    {(name, type): профиль} по активным (не удалённым) профилям пользователя,
+    первое вхождение. Строится на каждый вызов: профилей у пользователя единицы,
+    а кэш пришлось бы сбрасывать на каждой правке profiles. Нужно несколько
+    поисков — держите результат в локальной переменной.
+    """
+    pmap: Dict[tuple, Dict[str, Any]] = {}
+    for p in urec.get("profiles", []):
+        if not p.get("deleted"):
+            pmap.setdefault((p.get("name"), p.get("type")), p)
+    return pmap
+
+
+def _remember_write(digest: bytes) -> None:
+    global _last_write_sig
+    try:
+        cur = os.stat(STATE_PATH)
+        _last_write_sig = (digest, cur.st_mtime_ns, cur.st_size)
+    except OSError:
+        _last_write_sig = None
+
+
+def _current_umask() -> int:
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+# права state.json как у os.open(..., 0o644) с учётом umask (mkstemp создаёт 0o600)
+_STATE_FILE_MODE = 0o644 & ~_current_umask()
+
+
+def _write_state(st: Dict[str, Any], rev: int) -> None:
+    """Пишет снимок ревизии rev; снимок старше уже записанного пропускает."""
+    global _written_rev
+    with _write_lock:
+        if rev < _written_rev:
+            logger.debug({"event": "state_write_skipped_stale", "rev": rev, "written": _written_rev})
+            return
+        _written_rev = rev
+        _write_state_locked(st)
+
+
+def _write_state_locked(st: Dict[str, Any]) -> None:
+    state_dir = os.path.dirname(STATE_PATH)
+    os.makedirs(state_dir, exist_ok=True)
+    # сериализуем один раз и пишем одним блоком; fsync файла и каталога —
+    # чтобы после сбоя не остаться с пустым/потерянным state.json
+    data = json.dumps(st, ensure_ascii=False, indent=2).encode("utf-8")
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    if _last_write_sig is not None and _last_write_sig[0] == digest:
+        # содержимое то же, что мы записали последним, и файл с тех пор не трогали
+        try:
+            cur = os.stat(STATE_PATH)
+            if (cur.st_mtime_ns, cur.st_size) == _last_write_sig[1:]:
+                return
+        except OSError:
+            pass
+    # уникальный tmp рядом с файлом: чужая/прерванная запись его не обрежет
+    fd, tmp = tempfile.mkstemp(dir=state_dir, prefix=".state-", suffix=".tmp")
+    try:
+        try:
+            os.fchmod(fd, _STATE_FILE_MODE)
+            _write_all(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, STATE_PATH)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    _fsync_dir(state_dir)
+    _remember_write(digest)
     try:
         _auto_backup_state_json(st)
     except Exception:
@@ -145,21 +278,45 @@ def save_state(st: Dict[str, Any]) -> None:
             pass
 
 
-def load_state() -> Dict[str, Any]:
+def save_state(st: Dict[str, Any]) -> None:
     """
-    Загружает состояние из state.json.
-    Теперь state.json хранит только пользователей (без профилей).
+    Синхронная запись. Ждёт запись save_state_async, если та уже идёт в потоке;
+    снимок из очереди старше этого — его писатель увидит ревизию и пропустит.
     """
-    if not os.path.isdir(DATA_DIR):
-        os.makedirs(DATA_DIR, exist_ok=True)
-    if not os.path.exists(STATE_PATH):
-        return {"users": {}}  # users: {tg_id: {...}}
-    with open(STATE_PATH, "r", encoding="utf-8") as f:
-        st = json.load(f)
-    # нормализация
-    users = st.setdefault("users", {})
-    changed = False
+    global _unsaved_state, _state_rev
+    _state_rev += 1
+    rev = _state_rev
+    _unsaved_state = None
+    _write_state(st, rev)
 
+
+async def save_state_async(st: Dict[str, Any]) -> None:
+    """
+    Сохраняет состояние в отдельном потоке, не блокируя event loop.
+    Пока идёт запись, новые вызовы только подменяют ожидающий снимок —
+    серия быстрых изменений превращается в одну запись последнего.
+    После возврата снимок st уже на диске (или вытеснен более новым).
+    """
+    global _pending_state, _unsaved_state, _state_rev
+    _state_rev += 1
+    _pending_state = (_state_rev, st)
+    _unsaved_state = st
+    async with _save_lock:
+        pending = _pending_state
+        if pending is None:
+            return
+        _pending_state = None
+        rev, snap = pending
+        try:
+            await asyncio.to_thread(_write_state, snap, rev)
+        finally:
+            if _unsaved_state is snap:
+                _unsaved_state = None
+
+
+def _migrate_state(st: Dict[str, Any]) -> None:
+    """Дозаполняет обязательные поля пользователей и проставляет версию схемы."""
+    users = st.setdefault("users", {})
     for tid, rec in list(users.items()):
         if not isinstance(rec, dict):
             users[tid] = {
@@ -168,21 +325,57 @@ def load_state() -> Dict[str, Any]:
                 "first_name": "",
                 "created_at": now_iso(),
             }
-            changed = True
             continue
-        if "allowed" not in rec:
-            rec["allowed"] = False
-            changed = True
-        if "username" not in rec:
-            rec["username"] = ""
-            changed = True
-        if "first_name" not in rec:
-            rec["first_name"] = ""
-            changed = True
-        if "created_at" not in rec:
-            rec["created_at"] = now_iso()
-            changed = True
-    if changed:
+        rec.setdefault("allowed", False)
+        rec.setdefault("username", "")
+        rec.setdefault("first_name", "")
+        rec.setdefault("created_at", now_iso())
+    st["schema"] = STATE_SCHEMA
+
+
+def state_revision() -> tuple[int, int]:
+    """
+    Версия состояния для кэшей производных данных: (счётчик сохранений, mtime_ns).
+    mtime ловит правки state.json в обход бота.
+    """
+    try:
+        mtime_ns = os.stat(STATE_PATH).st_mtime_ns
+    except OSError:
+        mtime_ns = 0
+    return _state_rev, mtime_ns
+
+
+def get_sorted_tids(st: Dict[str, Any] | None = None) -> tuple[str, ...]:
+    """
+    tid пользователей по возрастанию (как int). Сортируем только ключи
+    и только после изменения состояния; st можно передать, если он уже загружен.
+    """
+    global _sorted_tids_cache, _sorted_tids_rev
+    rev = state_revision()
+    if _sorted_tids_cache is None or _sorted_tids_rev != rev:
+        users = (st if st is not None else load_state()).get("users", {})
+        _sorted_tids_cache = tuple(sorted(users, key=int))
+        _sorted_tids_rev = rev
+    return _sorted_tids_cache
+
+
+def load_state() -> Dict[str, Any]:
+    """
+    Загружает состояние из state.json.
+    Теперь state.json хранит только пользователей (без профилей).
+    """
+    if _unsaved_state is not None:
+        # запись ещё в очереди/в потоке — читаем свои же изменения
+        return copy.deepcopy(_unsaved_state)
+    if not os.path.isdir(DATA_DIR):
+        os.makedirs(DATA_DIR, exist_ok=True)
+    if not os.path.exists(STATE_PATH):
+        return {"users": {}, "schema": STATE_SCHEMA}  # users: {tg_id: {...}}
+    with open(STATE_PATH, "r", encoding="utf-8") as f:
+        st = json.load(f)
+    # миграция legacy-записей — один раз, дальше файл помечен версией схемы
+    if st.get("schema") != STATE_SCHEMA:
+        _migrate_state(st)
         save_state(st)
     return st
 
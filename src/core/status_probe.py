@@ -1,11 +1,75 @@
 from __future__ import annotations
-import os, re, time, shlex
+import os, re, time, shlex, threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Any
 
 from core.docker import run_cmd, _docker_exec, dir_size_bytes
 
 
+# Кэш объёма /app/data: обход дерева дорогой, пересчитываем при смене mtime каталога
+# или по истечении TTL (mtime не ловит рост во вложенных каталогах)
+DATA_SIZE_TTL_SEC = 30.0
+_size_cache: dict[str, Any] = {"mtime_ns": 0, "value": 0, "ts": 0.0}
+
+
+def _data_dir_size_bytes(path: str = "/app/data") -> int:
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime_ns = 0
+    now = time.monotonic()
+    if (
+        _size_cache["ts"]
+        and mtime_ns == _size_cache["mtime_ns"]
+        and (now - _size_cache["ts"]) < DATA_SIZE_TTL_SEC
+    ):
+        return _size_cache["value"]
+    value = dir_size_bytes(path)
+    _size_cache.update(mtime_ns=mtime_ns, value=value, ts=now)
+    return value
+
+
+# Кэш docker ps / docker stats: частые «Обновить» и пара probe+render
+# в одном запросе делят один вызов docker CLI
+DOCKER_CACHE_TTL_SEC = float(os.getenv("STATUS_DOCKER_CACHE_TTL_SEC", "3"))
+_docker_cache: dict[str, tuple[float, Any]] = {}
+# свой замок на ключ, держим на время вызова: параллельные запросы того же ключа
+# ждут первый, а не дублируют его; медленный stats при этом не держит ps
+_docker_cache_locks: dict[str, threading.Lock] = {"ps": threading.Lock(), "stats": threading.Lock()}
+
+
+def _docker_cached(key: str, fn, force: bool = False):
+    with _docker_cache_locks[key]:
+        hit = _docker_cache.get(key)
+        now = time.monotonic()
+        if not force and hit is not None and (now - hit[0]) < DOCKER_CACHE_TTL_SEC:
+            return hit[1]
+        value = fn()
+        _docker_cache[key] = (time.monotonic(), value)
+        return value
+
+
+def _docker_ps_statuses_raw() -> dict:
+    rc_ps, out_ps, _ = run_cmd("docker ps --format '{{.Names}}\\t{{.Status}}'")
+    statuses = {}
+    if rc_ps == 0 and out_ps:
+        for line in out_ps.splitlines():
+            name, sep, status = line.partition("\t")
+            if not sep:
+                continue
+            statuses[name] = status
+    return statuses
+
+
+def docker_ps_statuses(force: bool = False) -> dict:
+    """
+    {name: status} из docker ps, с кэшем на DOCKER_CACHE_TTL_SEC.
+    force=True — всегда свежий вызов.
+    """
+    return dict(_docker_cached("ps", _docker_ps_statuses_raw, force))
+
+
 def human_seconds(s: float) -> str:
     s = int(s)
     if s < 60:
@@ -17,11 +81,15 @@ def human_seconds(s: float) -> str:
     return f"{h}h{'' if m==0 else f' {m}m'}"
 
 
-def docker_stats() -> dict:
+def docker_stats(force: bool = False) -> dict:
     """
     Возвращает словарь: {name: {"cpu": "1.23%", "mem": "123.4MiB / 512MiB", "memp": "24.1%"}}
-    Использует: docker stats --no-stream
+    Использует: docker stats --no-stream (кэш на DOCKER_CACHE_TTL_SEC, force — без кэша)
     """
+    return dict(_docker_cached("stats", _docker_stats_raw, force))
+
+
+def _docker_stats_raw() -> dict:
     fmt = "{{.Name}}\t{{.CPUPerc}}\t{{.MemUsage}}\t{{.MemPerc}}"
     rc, out, err = run_cmd(f"docker stats --no-stream --format '{fmt}'", timeout=8)
     stats = {}
@@ -36,32 +104,47 @@ def docker_stats() -> dict:
     return stats
 
 
+_UP_RE = re.compile(r"\bUp\s+(.+)", re.I)
+# (шаблон, замена) в порядке применения; компилируем один раз
+_UPTIME_SUBS = tuple(
+    (re.compile(pat, re.I), repl)
+    for pat, repl in (
+        (r"\babout\b", ""),
+        (r"\(healthy\)|\(unhealthy\)|\(.*?health.*?\)", ""),
+    )
+)
+_UPTIME_SUBS_2 = tuple(
+    (re.compile(pat, re.I), repl)
+    for pat, repl in (
+        (r"less\s+than\s+a\s+second", "less than 1 second"),
+        (r"less\s+than\s+1\s*second", "<1 second"),
+        (r"\b(an|a)\b", "1"),
+        (r"\bweeks?\b", "нед"),
+        (r"\bdays?\b", "дн"),
+        (r"\bhours?\b", "ч"),
+        (r"\bminutes?\b", "мин"),
+        (r"\bseconds?\b", "с"),
+        (r"<1\s*second", "<1 с"),
+    )
+)
+_WS_RE = re.compile(r"\s+")
+
+
 def humanize_uptime(status_text: str) -> str:
     """
     Превращает хвост после 'Up ...' в короткий RU-вид.
     """
     st = (status_text or "").strip()
-    m = re.search(r"\bUp\s+(.+)", st, flags=re.I)
+    m = _UP_RE.search(st)
     if not m:
         return st
     tail = m.group(1)
-    tail = re.sub(r"\babout\b", "", tail, flags=re.I)
-    tail = re.sub(r"\(healthy\)|\(unhealthy\)|\(.*?health.*?\)", "", tail, flags=re.I)
+    for rx, repl in _UPTIME_SUBS:
+        tail = rx.sub(repl, tail)
     tail = tail.replace("healthy", "").replace("unhealthy", "")
-    tail = re.sub(r"less\s+than\s+a\s+second", "less than 1 second", tail, flags=re.I)
-    tail = re.sub(r"less\s+than\s+1\s*second", "<1 second", tail, flags=re.I)
-    tail = re.sub(r"\b(an|a)\b", "1", tail, flags=re.I)
-    repl = [
-        (r"\bweeks?\b", "нед"),
-        (r"\bdays?\b", "дн"),
-        (r"\bhours?\b", "ч"),
-        (r"\bminutes?\b", "мин"),
-        (r"\bseconds?\b", "с"),
-        (r"<1\s*second", "<1 с"),
-    ]
-    for pat, ru in repl:
-        tail = re.sub(pat, ru, tail, flags=re.I)
-    tail = re.sub(r"\s+", " ", tail).strip().strip(",").strip()
+    for rx, repl in _UPTIME_SUBS_2:
+        tail = rx.sub(repl, tail)
+    tail = _WS_RE.sub(" ", tail).strip().strip(",").strip()
     return f"работает {tail}"
 
 
@@ -80,6 +163,11 @@ def prettify_container_status(name: str, status_text: str) -> str:
     return f"{emoji} {name} — {rus or 'не запущен'}"
 
 
+# Пул для параллельных проверок status_probe: потоки живут между вызовами,
+# а не создаются и join'ятся на каждый probe
+_probe_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="status-probe")
+
+
 def summarize_counters(ok: int, warn: int, bad: int) -> str:
     total = ok + warn + bad
     if bad > 0:
@@ -89,9 +177,10 @@ def summarize_counters(ok: int, warn: int, bad: int) -> str:
     return f"✅ Всё в порядке. Всего проверок: {total}."
 
 
-def status_probe() -> dict:
+def status_probe(force: bool = False) -> dict:
     """
     Собирает фактическое состояние, но НЕ формирует текст сообщений.
+    force=True — docker ps без кэша.
     """
     probe: dict[str, Any] = {}
     ok = warn = bad = 0
@@ -104,15 +193,7 @@ def status_probe() -> dict:
         probe["proxy_line"] = f"🔴 docker-proxy — ошибка ({err_ver or rc_ver})"
         bad += 1
 
-    rc_ps, out_ps, _ = run_cmd("docker ps --format '{{.Names}}\\t{{.Status}}'")
-    statuses = {}
-    if rc_ps == 0 and out_ps:
-        for line in out_ps.splitlines():
-            try:
-                name, status = line.split("\t", 1)
-                statuses[name] = status
-            except Exception:
-                pass
+    statuses = docker_ps_statuses(force)
 
     important = [
         os.getenv("AWG_CONTAINER", "amnezia-awg"),
@@ -141,7 +222,15 @@ def status_probe() -> dict:
 
     xray_c = os.getenv("XRAY_CONTAINER", "amnezia-xray")
     xray_cfg = os.getenv("XRAY_CONFIG_PATH", "/opt/amnezia/xray/server.json")
-    rc_x, _, _ = _docker_exec(xray_c, f"test -r {shlex.quote(xray_cfg)}")
+    awg_c = os.getenv("AWG_CONTAINER", "amnezia-awg")
+    awg_cfg = os.getenv("AWG_CONFIG_PATH", "/opt/amnezia/awg/wg0.conf")
+    # обе проверки конфигов независимы (и в разных контейнерах) — запускаем
+    # docker exec параллельно на общем пуле
+    fut_x = _probe_pool.submit(_docker_exec, xray_c, f"test -r {shlex.quote(xray_cfg)}")
+    fut_a = _probe_pool.submit(_docker_exec, awg_c, f"test -r {shlex.quote(awg_cfg)}")
+    rc_x, _, _ = fut_x.result()
+    rc_a, _, _ = fut_a.result()
+
     if rc_x == 0:
         probe["xray_line"] = f"🟢 XRay конфиг доступен в {xray_c}"
         ok += 1
@@ -149,9 +238,6 @@ def status_probe() -> dict:
         probe["xray_line"] = f"🔴 XRay конфиг недоступен в {xray_c}"
         bad += 1
 
-    awg_c = os.getenv("AWG_CONTAINER", "amnezia-awg")
-    awg_cfg = os.getenv("AWG_CONFIG_PATH", "/opt/amnezia/awg/wg0.conf")
-    rc_a, _, _ = _docker_exec(awg_c, f"test -r {shlex.quote(awg_cfg)}")
     if rc_a == 0:
         probe["awg_line"] = f"🟢 AmneziaWG конфиг доступен в {awg_c}"
         ok += 1
@@ -168,7 +254,7 @@ def status_probe() -> dict:
     except Exception:
         can_write = False
 
-    size_mb = dir_size_bytes("/app/data") / (1024 * 1024)
+    size_mb = _data_dir_size_bytes("/app/data") / (1024 * 1024)
     if can_write:
         probe["storage_line"] = f"🟢 /app/data — запись: да, объём: {size_mb:.1f} МБ"
         ok += 1
@@ -1,6 +1,7 @@
 # src/core/ui.py
 from __future__ import annotations
-import time
+import hashlib, itertools
+from collections import OrderedDict
 from typing import Optional
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message
 from telegram.ext import ContextTypes
@@ -8,11 +9,21 @@ from telegram.ext import ContextTypes
 SAFE_TXT = "\u2060"  # невидимый символ
 
 
+_salt_counter = itertools.count(1)
+
+
 def _salt_text(txt: str) -> str:
-    n = int((time.time() * 100) % 7) + 1  # 1..7
+    n = (next(_salt_counter) % 7) + 1  # 1..7
     return (txt or "") + (SAFE_TXT * n)
 
 
+def _msg_fingerprint(text: str, kb: Optional[InlineKeyboardMarkup]) -> bytes:
+    h = hashlib.blake2b((text or "").encode("utf-8"), digest_size=8)
+    if kb is not None:
+        h.update(kb.to_json().encode("utf-8"))
+    return h.digest()
+
+
 def _is_command_message(update) -> bool:
     try:
         return bool(
@@ -61,6 +72,17 @@ def _cb_message_is_last(update, context) -> bool:
         return True
 
 
+# Кнопка/клавиатура «в меню» — неизменяемые объекты PTB, создаются один раз
+_MENU_BTN = InlineKeyboardButton("🏠 В главное меню", callback_data="menu")
+_MENU_ONLY_KB = InlineKeyboardMarkup([[_MENU_BTN]])
+
+# kb -> результат ensure_main_menu_button; храним сам kb, чтобы id не переиспользовался
+_MENU_KB_CACHE: "OrderedDict[int, tuple[InlineKeyboardMarkup, InlineKeyboardMarkup]]" = (
+    OrderedDict()
+)
+_MENU_KB_CACHE_MAX = 128
+
+
 def ensure_main_menu_button(
     kb: Optional[InlineKeyboardMarkup],
     add_menu_button: bool = True,
@@ -68,9 +90,11 @@ def ensure_main_menu_button(
     if not add_menu_button:
         return kb
     if kb is None:
-        return InlineKeyboardMarkup(
-            [[InlineKeyboardButton("🏠 В главное меню", callback_data="menu")]]
-        )
+        return _MENU_ONLY_KB
+    cached = _MENU_KB_CACHE.get(id(kb))
+    if cached is not None and cached[0] is kb:
+        _MENU_KB_CACHE.move_to_end(id(kb))
+        return cached[1]
     rows = list(kb.inline_keyboard or [])
     try:
         exists = any(
@@ -80,9 +104,11 @@ def ensure_main_menu_button(
         )
     except Exception:
         exists = False
-    if not exists:
-        rows.append([InlineKeyboardButton("🏠 В главное меню", callback_data="menu")])
-    return InlineKeyboardMarkup(rows)
+    res = kb if exists else InlineKeyboardMarkup([*rows, [_MENU_BTN]])
+    _MENU_KB_CACHE[id(kb)] = (kb, res)
+    if len(_MENU_KB_CACHE) > _MENU_KB_CACHE_MAX:
+        _MENU_KB_CACHE.popitem(last=False)
+    return res
 
 
 async def clean_and_send(
@@ -161,14 +187,21 @@ async def edit_or_send(
                 return sent
 
             try:
-                return await q.edit_message_text(
-                    text or SAFE_TXT,
-                    reply_markup=ensure_main_menu_button(
-                        kb, add_menu_button=add_menu_button
-                    ),
+                body = text or SAFE_TXT
+                markup = ensure_main_menu_button(kb, add_menu_button=add_menu_button)
+                fp = (q.message.message_id, _msg_fingerprint(body, markup))
+                if context.chat_data.get("last_msg_hash") == fp:
+                    # то же сообщение с тем же текстом и кнопками: Telegram ответит
+                    # "message is not modified" — солим сразу, без лишнего RPC
+                    body = _salt_text(body)
+                res = await q.edit_message_text(
+                    body,
+                    reply_markup=markup,
                     parse_mode=parse_mode,
                     disable_web_page_preview=True,
                 )
+                context.chat_data["last_msg_hash"] = fp
+                return res
             except Exception as e1:
                 emsg = (str(e1) or "").lower()
                 if "message is not modified" in emsg:
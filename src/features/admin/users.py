@@ -1,16 +1,45 @@
 # src/features/admin/users.py
 from __future__ import annotations
 from typing import Dict, Any, List, Optional
+import heapq
 from datetime import datetime
+from functools import lru_cache
 
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Update
 from telegram.ext import ContextTypes
 
 from core.ui import edit_or_send
-from core.state import load_state, save_state, now_iso
+from core.state import (
+    load_state,
+    save_state,
+    now_iso,
+    state_revision,
+    get_sorted_tids,
+    profile_map,
+)
 from core import repo_awg as AWG
 from core import repo_xray as XR
 
+# --- неизменяемые кнопки (PTB-объекты frozen, можно переиспользовать) ---
+
+_BACK_TO_ADMIN_MENU = InlineKeyboardButton("⬅️ Назад", callback_data="admin_menu")
+_BACK_TO_ADMIN_LIST = InlineKeyboardButton("⬅️ Назад", callback_data="admin_list")
+
+
+@lru_cache(maxsize=256)
+def _page_btn(label: str, page: int) -> InlineKeyboardButton:
+    """Кнопка навигации по списку пользователей — одна на (стрелка, страница)."""
+    return InlineKeyboardButton(label, callback_data=f"admin_list_page:{page}")
+
+
+_USER_CARD_TMPL = (
+    "<b>Пользователь</b> <code>%s</code>\n"
+    "username: <code>@%s</code>\n"
+    "имя: <code>%s</code>\n"
+    "доступ: <code>%s</code>"
+)
+
+
 # --- helpers (локальные, без зависимости от bot.py) ---
 
 
@@ -19,17 +48,13 @@ def _profiles_active(user: Dict[str, Any]) -> List[Dict[str, Any]]:
 
 
 def _xray_status_for_user(
-    user_rec: Dict[str, Any], tg_id: int, pname: str
+    pmap: Dict[tuple, Dict[str, Any]], tg_id: int, pname: str
 ) -> tuple[str, str]:
-    """Возвращает ("active"|"suspended"|"absent", удобочитаемая метка)."""
-    pr = next(
-        (
-            p
-            for p in _profiles_active(user_rec)
-            if p.get("type") == "xray" and p.get("name") == pname
-        ),
-        None,
-    )
+    """
+    Возвращает ("active"|"suspended"|"absent", удобочитаемая метка).
+    pmap — profile_map(user_rec), строится вызывающим один раз на пользователя.
+    """
+    pr = pmap.get((pname, "xray"))
     if not pr:
         return ("absent", "Отсутствует ⚠️")
     if pr.get("suspended"):
@@ -41,6 +66,47 @@ def _xray_status_for_user(
         return ("absent", "Отсутствует ⚠️")
 
 
+# Кэш отсортированного списка пользователей (ключ — state_revision())
+_user_rows_cache: Dict[str, Any] = {"rev": None, "rows": []}
+
+
+def _sorted_user_rows() -> list[tuple[str, bool, str]]:
+    """
+    (tid, allowed, username) по возрастанию tid — для постраничного списка.
+    Пересчитывается только при смене ревизии state, листание страниц
+    не перечитывает и не пересортировывает state.json.
+    """
+    rev = state_revision()
+    if _user_rows_cache["rev"] != rev:
+        st = load_state()
+        users = st.get("users", {})
+        rows = []
+        for tid in get_sorted_tids(st):
+            rec = users.get(tid) or {}
+            rows.append((tid, bool(rec.get("allowed")), rec.get("username") or ""))
+        _user_rows_cache["rows"] = rows
+        _user_rows_cache["rev"] = rev
+    return _user_rows_cache["rows"]
+
+
+def _user_page_rows(page: int, page_size: int) -> tuple[list, int]:
+    """
+    Строки страницы и общее число пользователей.
+    Первая страница при холодном кэше — через heapq.nsmallest, без полной
+    сортировки (O(N log page_size)); остальные — срез из _sorted_user_rows.
+    """
+    if page == 0 and _user_rows_cache["rev"] != state_revision():
+        users = load_state().get("users", {})
+        first = heapq.nsmallest(page_size, users.items(), key=lambda kv: int(kv[0]))
+        rows = [
+            (tid, bool(rec.get("allowed")), rec.get("username") or "")
+            for tid, rec in first
+        ]
+        return rows, len(users)
+    items = _sorted_user_rows()
+    return items[page * page_size : (page + 1) * page_size], len(items)
+
+
 # --- экспортируемые вьюхи ---
 
 
@@ -50,15 +116,13 @@ async def show_admin_user_list(
     page: int = 0,
     page_size: int = 10,
 ):
-    st = load_state()
-    items = sorted(st.get("users", {}).items(), key=lambda kv: int(kv[0]))
-    total = len(items)
+    page_rows, total = _user_page_rows(page, page_size)
     start, end = page * page_size, min((page + 1) * page_size, total)
 
     rows = []
-    for tid, rec in items[start:end]:
-        tag = "✅" if rec.get("allowed") else "⛔"
-        uname = rec.get("username") or "-"
+    for tid, allowed, uname in page_rows:
+        tag = "✅" if allowed else "⛔"
+        uname = uname or "-"
         rows.append(
             [
                 InlineKeyboardButton(
@@ -69,10 +133,10 @@ async def show_admin_user_list(
 
     nav = []
     if page > 0:
-        nav.append(InlineKeyboardButton("⬅️", callback_data=f"admin_list_page:{page-1}"))
+        nav.append(_page_btn("⬅️", page - 1))
     if end < total:
-        nav.append(InlineKeyboardButton("➡️", callback_data=f"admin_list_page:{page+1}"))
-    rows.append(nav or [InlineKeyboardButton("⬅️ Назад", callback_data="admin_menu")])
+        nav.append(_page_btn("➡️", page + 1))
+    rows.append(nav or [_BACK_TO_ADMIN_MENU])
 
     kb = InlineKeyboardMarkup(rows)
     txt = f"Пользователи {start+1}–{end} из {total}"
@@ -98,14 +162,14 @@ async def show_admin_user_card(
     tag = (
         "✅ Разрешить → Запретить" if rec.get("allowed") else "⛔ Запретить → Разрешить"
     )
-    lines = [
-        f"<b>Пользователь</b> <code>{tid}</code>",
-        f"username: <code>@{rec.get('username') or '-'}</code>",
-        f"имя: <code>{rec.get('first_name') or '-'}</code>",
-        f"доступ: <code>{'yes' if rec.get('allowed') else 'no'}</code>",
-    ]
+    txt = _USER_CARD_TMPL % (
+        tid,
+        rec.get("username") or "-",
+        rec.get("first_name") or "-",
+        "yes" if rec.get("allowed") else "no",
+    )
     if note:
-        lines += ["", note]
+        txt += "\n\n" + note
 
     rows = [
         [InlineKeyboardButton(tag, callback_data=f"admin_user_toggle:{tid}")],
@@ -114,10 +178,9 @@ async def show_admin_user_card(
                 "👤 Профили", callback_data=f"admin_user_profiles:{tid}"
             )
         ],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="admin_list")],
+        [_BACK_TO_ADMIN_LIST],
     ]
     kb = InlineKeyboardMarkup(rows)
-    txt = "\n".join(lines)
 
     if replace and update.callback_query:
         try:
@@ -144,7 +207,7 @@ async def show_admin_user_profiles(
             context,
             "Пользователь не найден.",
             InlineKeyboardMarkup(
-                [[InlineKeyboardButton("⬅️ Назад", callback_data="admin_list")]]
+                [[_BACK_TO_ADMIN_LIST]]
             ),
         )
         return
@@ -163,10 +226,19 @@ async def show_admin_user_profiles(
         )
         return
 
+    # статусы Xray нужны дважды (кнопки и массовые действия) — одно чтение clientsTable
+    pmap = profile_map(urec)
+    with XR.xray_batch():
+        xray_status = {
+            p.get("name"): _xray_status_for_user(pmap, int(tid), p.get("name") or "")[0]
+            for p in act
+            if p.get("type") == "xray"
+        }
+
     for p in act:
         name, ptype = p.get("name"), p.get("type")
         if ptype == "xray":
-            status, _ = _xray_status_for_user(urec, int(tid), name)
+            status = xray_status[name]
             left = f"{name} · {'▶️' if status=='active' else '⏸' if status=='suspended' else '⚠️'}"
         else:
             left = f"{name} · {ptype}"
@@ -185,7 +257,7 @@ async def show_admin_user_profiles(
         cnt_active = 0
         cnt_susp = 0
         for p in xray_profiles:
-            status, _ = _xray_status_for_user(urec, int(tid), p.get("name", ""))
+            status = xray_status[p.get("name")]
             if status == "active":
                 cnt_active += 1
             elif status == "suspended":
@@ -227,25 +299,20 @@ async def show_admin_profile_card(
 ):
     st = load_state()
     urec = st.get("users", {}).get(tid, {})
-    pr = next(
-        (
-            p
-            for p in _profiles_active(urec)
-            if p.get("name") == pname and p.get("type") == ptype
-        ),
-        None,
-    )
+    pmap = profile_map(urec)
+    pr = pmap.get((pname, ptype))
     if not pr:
         await show_admin_user_profiles(update, context, tid, note="Профиль не найден.")
         return
 
     if ptype == "xray":
         info = None
-        try:
-            info = XR.find_user(int(tid), pname)
-        except Exception:
-            info = None
-        status, status_label = _xray_status_for_user(urec, int(tid), pname)
+        with XR.xray_batch():
+            try:
+                info = XR.find_user(int(tid), pname)
+            except Exception:
+                info = None
+            status, status_label = _xray_status_for_user(pmap, int(tid), pname)
         lines = [f"<b>{pname}</b> · Xray"]
         if info:
             lines.append(f"• UUID: <code>{info.get('uuid','')}</code>")
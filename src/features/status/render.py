@@ -1,14 +1,35 @@
 # src/features/status/render.py
 from __future__ import annotations
-import os, time
+import os, math, time
 from datetime import datetime
 from typing import List
 
-from core.docker import run_cmd
-from core.status_probe import humanize_uptime, docker_stats, human_seconds
+from core.status_probe import (
+    humanize_uptime,
+    docker_stats,
+    docker_ps_statuses,
+    human_seconds,
+)
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+# Контейнеры, которые показываем в статусе (env читаем один раз при импорте)
+IMPORTANT_CONTAINERS = (
+    os.getenv("AWG_CONTAINER", "amnezia-awg"),
+    os.getenv("XRAY_CONTAINER", "amnezia-xray"),
+    os.getenv("DNS_CONTAINER", "amnezia-dns"),
+    "awgbot",
+)
+
+# Подстрока статуса -> бейдж; порядок важен ("unhealthy" раньше "healthy")
+_BADGE_RULES = (
+    ("unhealthy", "🟡"),
+    ("restarting", "🟡"),
+    ("healthy", "🟢"),
+    ("up", "🟢"),
+)
+
+
 def build_status_kb(_want_full: bool | None = None) -> InlineKeyboardMarkup:
     # сейчас всегда длинный статус; только refresh + в меню
     return InlineKeyboardMarkup(
@@ -18,29 +39,62 @@ def build_status_kb(_want_full: bool | None = None) -> InlineKeyboardMarkup:
         ]
     )
 
+_STATUS_HEAD_TMPL = (
+    "🧩 <b>Статус</b> <code>%s</code>\n"
+    "⏱️ Аптайм бота: <code>%s</code>\n"
+    "%s\n"
+    "\n"
+    "Контейнеры"
+)
+_STATUS_INFRA_TMPL = (
+    "\n"
+    "Инфраструктура\n"
+    "• %s\n"
+    "• %s\n"
+    "• %s\n"
+    "• %s\n"
+    "• %s\n"
+    "\n"
+    "📊 Ресурсы"
+)
+
+
+def _human_bytes(n: float) -> str:
+    """Размер в стиле `df -h`: 1024-кратные единицы, 1 знак после запятой до 10."""
+    for unit in ("", "K", "M", "G", "T"):
+        if n < 1024 or unit == "T":
+            break
+        n /= 1024
+    if unit and n < 10:
+        return f"{math.ceil(n * 10) / 10:.1f}{unit}"
+    return f"{math.ceil(n)}{unit}"
+
+
+def _disk_usage_line(path: str) -> str:
+    """То же, что давал `df -h | awk`, но одним statvfs без шелла."""
+    try:
+        sv = os.statvfs(path)
+    except OSError:
+        return ""
+    total = sv.f_blocks * sv.f_frsize
+    free = sv.f_bavail * sv.f_frsize
+    used = (sv.f_blocks - sv.f_bfree) * sv.f_frsize
+    # df считает Use% от used+avail (без блоков root) и округляет вверх
+    denom = used + free
+    pct = math.ceil(100 * used / denom) if denom else 0
+    return f"{_human_bytes(total)} всего, {_human_bytes(free)} свободно ({pct}% занято)"
+
+
 def render_status_full(probe: dict) -> List[str]:
     """
     Всегда рендерит ПОЛНЫЙ статус на основе probe из core.status_probe.status_probe().
     """
     now_local = datetime.now().astimezone().strftime("%H:%M:%S %d.%m.%Y")
 
-    # docker ps для аптаймов контейнеров
-    rc_ps, out_ps, _ = run_cmd("docker ps --format '{{.Names}}\\t{{.Status}}'")
-    statuses: dict[str, str] = {}
-    if rc_ps == 0 and out_ps:
-        for line in out_ps.splitlines():
-            try:
-                name, status = line.split("\t", 1)
-                statuses[name] = status
-            except Exception:
-                pass
-
-    important = [
-        os.getenv("AWG_CONTAINER", "amnezia-awg"),
-        os.getenv("XRAY_CONTAINER", "amnezia-xray"),
-        os.getenv("DNS_CONTAINER", "amnezia-dns"),
-        "awgbot",
-    ]
+    # docker ps для аптаймов контейнеров (тот же кэш, что и у status_probe)
+    statuses: dict[str, str] = docker_ps_statuses()
+
+    important = IMPORTANT_CONTAINERS
 
     summary = probe.get("summary", "—")
     proxy_line = probe.get("proxy_line", "docker-proxy: —")
@@ -54,14 +108,10 @@ def render_status_full(probe: dict) -> List[str]:
     for name in important:
         st = statuses.get(name, "не запущен")
         low = st.lower()
-        if ("unhealthy" in low) or ("restarting" in low):
-            badge = "🟡"
-            nice = humanize_uptime(st) if "up" in low else (st or "не запущен")
-        elif ("up" in low) or ("healthy" in low):
-            badge = "🟢"
-            nice = humanize_uptime(st) if "up" in low else (st or "не запущен")
+        badge = next((b for needle, b in _BADGE_RULES if needle in low), "🔴")
+        if badge != "🔴" and "up" in low:
+            nice = humanize_uptime(st)
         else:
-            badge = "🔴"
             nice = st or "не запущен"
         cont_block.append(f"{badge} {name} — {nice}")
 
@@ -71,22 +121,12 @@ def render_status_full(probe: dict) -> List[str]:
         # запасной расчёт, если его не передали
         bot_uptime = human_seconds(0)
 
+    # постоянные блоки — одной %-подстановкой; элементы списка могут быть
+    # многострочными, вызывающий всё равно склеивает через "\n"
     lines: list[str] = [
-        f"🧩 <b>Статус</b> <code>{now_local}</code>",
-        f"⏱️ Аптайм бота: <code>{bot_uptime}</code>",
-        summary,
-        "",
-        "Контейнеры",
+        _STATUS_HEAD_TMPL % (now_local, bot_uptime, summary),
         *cont_block,
-        "",
-        "Инфраструктура",
-        f"• {proxy_line}",
-        f"• {xray_line}",
-        f"• {awg_line}",
-        f"• {storage_line}",
-        f"• {hb_line}",
-        "",
-        "📊 Ресурсы",
+        _STATUS_INFRA_TMPL % (proxy_line, xray_line, awg_line, storage_line, hb_line),
     ]
 
     # docker stats
@@ -99,10 +139,8 @@ def render_status_full(probe: dict) -> List[str]:
                     f"• {name}: CPU {s['cpu']}, Память {s['mem']} ({s['memp']})"
                 )
 
-    rc_df, out_df, _ = run_cmd(
-        'df -h /app/data | tail -n 1 | awk \'{print $2" всего, " $4" свободно ("$5" занято)"}\''
-    )
-    if rc_df == 0 and out_df:
+    out_df = _disk_usage_line("/app/data")
+    if out_df:
         lines.append(f"💽 /app/data: {out_df}")
 
     return lines
\ No newline at end of file
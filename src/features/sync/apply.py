@@ -1,9 +1,10 @@
 # src/features/sync/apply.py
 from __future__ import annotations
+from contextvars import ContextVar
 from typing import Dict, Any, List
 import logging
 
-from core.state import load_state, save_state, now_iso
+from core.state import load_state, save_state, now_iso, profile_map
 from core import repo_xray as XR
 
 logger = logging.getLogger(__name__)
@@ -13,6 +14,11 @@ def profiles_active(user: Dict[str, Any]) -> List[Dict[str, Any]]:
     return [p for p in user.get("profiles", []) if not p.get("deleted")]
 
 
+# profile_map по tid на время одного sync_apply_all: у пользователя обычно
+# несколько пунктов, карту строим один раз. Состав profiles прогон не меняет.
+_run_pmaps: ContextVar[dict[int, dict] | None] = ContextVar("sync_apply_pmaps", default=None)
+
+
 def _get_state_profile(
     st: dict, tid: int, name: str
 ) -> tuple[dict | None, dict | None]:
@@ -20,29 +26,44 @@ def _get_state_profile(
     urec = st.get("users", {}).get(str(tid))
     if not isinstance(urec, dict):
         return None, None
-    for p in profiles_active(urec):
-        if p.get("type") == "xray" and p.get("name") == name:
-            return urec, p
-    return urec, None
+    pmaps = _run_pmaps.get()
+    if pmaps is None:
+        return urec, profile_map(urec).get((name, "xray"))
+    pmap = pmaps.get(tid)
+    if pmap is None:
+        pmap = pmaps[tid] = profile_map(urec)
+    return urec, pmap.get((name, "xray"))
 
 
 def _log_apply(event: str, **kw):
-    try:
-        logger.info({"event": event, **kw})
-    except Exception:
-        pass
+    # payload собираем только если INFO реально пишется
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    logger.info({"event": event, **kw})
 
 
-def _find_xray_bot_client(tid: int, name: str) -> dict | None:
-    """Ищет 'своего' клиента Xray по (tid,name)."""
+def _find_xray_bot_client(
+    tid: int, name: str, index: dict | None = None
+) -> dict | None:
+    """
+    Ищет 'своего' клиента Xray по (tid,name).
+    index — готовый словарь {(tid, name): client} из sync_collect (xray_by_key),
+    тогда server.json повторно не читаем.
+    """
+    tid = int(tid)
+    if index is not None:
+        return index.get((tid, name))
+    # без индекса — устаревший путь: читаем Xray целиком ради одного клиента
+    logger.debug({"event": "xray_bot_client_lookup_no_index", "tid": tid, "name": name})
     try:
         xlist = XR.list_all() or []
     except Exception:
         xlist = []
     for c in xlist:
-        if c.get("source") != "bot":
+        # сначала дешёвые сравнения, int() — только для совпавших по имени
+        if (c.get("name") or "") != name or c.get("source") != "bot":
             continue
-        if int(c.get("tid") or 0) == int(tid) and (c.get("name") or "") == name:
+        if int(c.get("tid") or 0) == tid:
             return c
     return None
 
@@ -50,12 +71,11 @@ def _find_xray_bot_client(tid: int, name: str) -> dict | None:
 # ----------- ABSENT -----------
 
 
-def sync_absent_apply_one(tid: int, name: str) -> tuple[bool, str]:
+def _absent_apply(st: dict, tid: int, name: str) -> tuple[bool, str]:
     """
     Починить ONLY_IN_STATE для одного профиля: добавить профиль в Xray.
-    Возвращает (ok, reason).
+    Меняет st в памяти, не сохраняет. Возвращает (ok, reason).
     """
-    st = load_state()
     urec, pr = _get_state_profile(st, tid, name)
     if not urec:
         _log_apply(
@@ -103,7 +123,6 @@ def sync_absent_apply_one(tid: int, name: str) -> tuple[bool, str]:
         if isinstance(res, dict) and res.get("uuid"):
             pr["uuid"] = res["uuid"]
         pr["last_xray_sync_at"] = now_iso()
-        save_state(st)
         _log_apply(
             "sync_absent_apply_one",
             tid=tid,
@@ -125,51 +144,29 @@ def sync_absent_apply_one(tid: int, name: str) -> tuple[bool, str]:
         return False, "xray_add_fail"
 
 
+def sync_absent_apply_one(tid: int, name: str) -> tuple[bool, str]:
+    st = load_state()
+    ok, reason = _absent_apply(st, tid, name)
+    if ok:
+        save_state(st)
+    return ok, reason
+
+
 def sync_absent_apply_all() -> dict:
-    from .collect import sync_collect as _collect
-
-    snap = _collect()
-    items = snap.get("only_in_state", [])
-    total = len(items)
-    done = skipped = errors = 0
-    results = []
-    for it in items:
-        tid = int(it.get("tid") or 0)
-        name = it.get("name") or ""
-        ok, reason = sync_absent_apply_one(tid, name)
-        results.append({"tid": tid, "name": name, "ok": ok, "reason": reason})
-        if ok:
-            done += 1
-        else:
-            if reason in (
-                "user_not_in_state",
-                "profile_not_in_state",
-                "profile_suspended",
-                "already_present",
-            ):
-                skipped += 1
-            else:
-                errors += 1
-    summary = {
-        "total": total,
-        "done": done,
-        "skipped": skipped,
-        "errors": errors,
-        "items": results,
-    }
-    _log_apply("sync_absent_apply_all", **summary)
-    return summary
+    return sync_apply_all(("absent",))["absent"]
 
 
 # ----------- EXTRA -----------
 
 
-def sync_extra_apply_one(tid: int, name: str) -> tuple[bool, str]:
+def sync_extra_apply_one(
+    tid: int, name: str, index: dict | None = None
+) -> tuple[bool, str]:
     """
     Починить ONLY_IN_XRAY (свои): удалить "лишнего" клиента из Xray.
     Работает ТОЛЬКО для клиентов source=bot.
     """
-    target = _find_xray_bot_client(tid, name)
+    target = _find_xray_bot_client(tid, name, index)
     if not target:
         _log_apply(
             "sync_extra_apply_one",
@@ -213,45 +210,20 @@ def sync_extra_apply_one(tid: int, name: str) -> tuple[bool, str]:
 
 
 def sync_extra_apply_all() -> dict:
-    from .collect import sync_collect as _collect
-
-    snap = _collect()
-    items = snap.get("only_in_xray", [])
-    total = len(items)
-    done = skipped = errors = 0
-    results = []
-    for it in items:
-        tid = int(it.get("tid") or 0)
-        name = it.get("name") or ""
-        ok, reason = sync_extra_apply_one(tid, name)
-        results.append({"tid": tid, "name": name, "ok": ok, "reason": reason})
-        if ok:
-            done += 1
-        else:
-            if reason == "not_found_in_xray":
-                skipped += 1
-            else:
-                errors += 1
-    summary = {
-        "total": total,
-        "done": done,
-        "skipped": skipped,
-        "errors": errors,
-        "items": results,
-    }
-    _log_apply("sync_extra_apply_all", **summary)
-    return summary
+    return sync_apply_all(("extra",))["extra"]
 
 
 # ----------- DIVERGED -----------
 
 
-def sync_diverged_update_db_one(tid: int, name: str) -> tuple[bool, str]:
+def _diverged_update_db(
+    st: dict, tid: int, name: str, index: dict | None = None
+) -> tuple[bool, str]:
     """
     Обновляет БД (state.json) по факту из Xray для одного diverged профиля.
     Разрешено даже если профиль suspended или у пользователя снят доступ.
+    Меняет st в памяти, не сохраняет.
     """
-    st = load_state()
     urec, pr = _get_state_profile(st, tid, name)
     if not urec or not pr:
         _log_apply(
@@ -263,7 +235,7 @@ def sync_diverged_update_db_one(tid: int, name: str) -> tuple[bool, str]:
         )
         return False, "profile_not_in_state"
 
-    xr = _find_xray_bot_client(tid, name)
+    xr = _find_xray_bot_client(tid, name, index)
     if not xr:
         _log_apply(
             "sync_diverged_update_db_one",
@@ -279,7 +251,6 @@ def sync_diverged_update_db_one(tid: int, name: str) -> tuple[bool, str]:
     if pr.get("flow") is not None and xr.get("flow"):
         pr["flow"] = xr["flow"]
     pr["last_xray_sync_at"] = now_iso()
-    save_state(st)
 
     _log_apply(
         "sync_diverged_update_db_one",
@@ -292,12 +263,20 @@ def sync_diverged_update_db_one(tid: int, name: str) -> tuple[bool, str]:
     return True, "ok"
 
 
-def sync_diverged_rebuild_xray_one(tid: int, name: str) -> tuple[bool, str]:
+def sync_diverged_update_db_one(tid: int, name: str) -> tuple[bool, str]:
+    st = load_state()
+    ok, reason = _diverged_update_db(st, tid, name)
+    if ok:
+        save_state(st)
+    return ok, reason
+
+
+def _diverged_rebuild_xray(st: dict, tid: int, name: str) -> tuple[bool, str]:
     """
     Пересобирает запись в Xray, приводя её к данным из БД (uuid/flow).
     Пропускаем, если профиль suspended или у пользователя снят доступ.
+    Меняет st в памяти, не сохраняет.
     """
-    st = load_state()
     urec, pr = _get_state_profile(st, tid, name)
     if not urec or not pr:
         _log_apply(
@@ -368,7 +347,6 @@ def sync_diverged_rebuild_xray_one(tid: int, name: str) -> tuple[bool, str]:
         return False, "xray_update_exc"
 
     pr["last_xray_sync_at"] = now_iso()
-    save_state(st)
     _log_apply(
         "sync_diverged_rebuild_xray_one",
         tid=tid,
@@ -380,68 +358,116 @@ def sync_diverged_rebuild_xray_one(tid: int, name: str) -> tuple[bool, str]:
     return True, "ok"
 
 
+def sync_diverged_rebuild_xray_one(tid: int, name: str) -> tuple[bool, str]:
+    st = load_state()
+    ok, reason = _diverged_rebuild_xray(st, tid, name)
+    if ok:
+        save_state(st)
+    return ok, reason
+
+
 def sync_diverged_update_db_all() -> dict:
-    from .collect import sync_collect as _collect
-
-    snap = _collect()
-    items = snap.get("diverged", [])
-    total = len(items)
-    done = skipped = errors = 0
-    results = []
-    for it in items:
-        tid = int(it.get("tid") or 0)
-        name = it.get("name") or ""
-        ok, reason = sync_diverged_update_db_one(tid, name)
-        results.append({"tid": tid, "name": name, "ok": ok, "reason": reason})
-        if ok:
-            done += 1
-        else:
-            if reason in ("profile_not_in_state", "not_found_in_xray"):
-                skipped += 1
-            else:
-                errors += 1
-    summary = {
-        "total": total,
-        "done": done,
-        "skipped": skipped,
-        "errors": errors,
-        "items": results,
-    }
-    _log_apply("sync_diverged_update_db_all", **summary)
-    return summary
+    return sync_apply_all(("diverged_db",))["diverged_db"]
 
 
 def sync_diverged_rebuild_xray_all() -> dict:
-    from .collect import sync_collect as _collect
-
-    snap = _collect()
-    items = snap.get("diverged", [])
-    total = len(items)
-    done = skipped = errors = 0
-    results = []
-    for it in items:
-        tid = int(it.get("tid") or 0)
-        name = it.get("name") or ""
-        ok, reason = sync_diverged_rebuild_xray_one(tid, name)
-        results.append({"tid": tid, "name": name, "ok": ok, "reason": reason})
-        if ok:
-            done += 1
-        else:
-            if reason in (
-                "user_disallowed",
-                "profile_suspended",
-                "profile_not_in_state",
-                "no_uuid_in_state",
-            ):
-                skipped += 1
-            else:
-                errors += 1
-    summary = {
-        "total": total,
-        "done": done,
-        "skipped": skipped,
-        "errors": errors,
-        "items": results,
-    }
-    _log_apply("sync_diverged_rebuild_xray_all", **summary)
-    return summary
+    return sync_apply_all(("diverged_xray",))["diverged_xray"]
+
+
+# ----------- ALL -----------
+
+# kind -> (корзина в sync_collect, обработчик (st, tid, name, index),
+#          причины «пропуска», событие лога, меняет ли state.json)
+_APPLY_KINDS: dict[str, tuple] = {
+    "absent": (
+        "only_in_state",
+        lambda st, tid, name, index: _absent_apply(st, tid, name),
+        (
+            "user_not_in_state",
+            "profile_not_in_state",
+            "profile_suspended",
+            "already_present",
+        ),
+        "sync_absent_apply_all",
+        True,
+    ),
+    "extra": (
+        "only_in_xray",
+        lambda st, tid, name, index: sync_extra_apply_one(tid, name, index),
+        ("not_found_in_xray",),
+        "sync_extra_apply_all",
+        False,
+    ),
+    "diverged_db": (
+        "diverged",
+        _diverged_update_db,
+        ("profile_not_in_state", "not_found_in_xray"),
+        "sync_diverged_update_db_all",
+        True,
+    ),
+    "diverged_xray": (
+        "diverged",
+        lambda st, tid, name, index: _diverged_rebuild_xray(st, tid, name),
+        (
+            "user_disallowed",
+            "profile_suspended",
+            "profile_not_in_state",
+            "no_uuid_in_state",
+        ),
+        "sync_diverged_rebuild_xray_all",
+        True,
+    ),
+}
+
+
+def sync_apply_all(kinds=("absent", "extra", "diverged_db")) -> dict:
+    """
+    Массовая починка за один проход: один sync_collect, один load_state,
+    одна запись state.json и одна запись clientsTable в конце (если что-то изменилось).
+    Возвращает {kind: summary} — summary как у sync_*_apply_all.
+    """
+    from .collect import sync_collect as _collect, invalidate_sync_collect
+
+    snap = _collect(force=True)
+    index = snap.get("xray_by_key")
+    st = load_state()
+    dirty = False
+    out: dict[str, dict] = {}
+    pmaps_token = _run_pmaps.set({})
+    try:
+        with XR.xray_batch():
+            for kind in kinds:
+                bucket, fn, skip_reasons, event, touches_state = _APPLY_KINDS[kind]
+                items = snap.get(bucket, [])
+                done = skipped = errors = 0
+                results = []
+                for it in items:
+                    tid = int(it.get("tid") or 0)
+                    name = it.get("name") or ""
+                    ok, reason = fn(st, tid, name, index)
+                    results.append({"tid": tid, "name": name, "ok": ok, "reason": reason})
+                    if ok:
+                        dirty = dirty or touches_state
+                        done += 1
+                    elif reason in skip_reasons:
+                        skipped += 1
+                    else:
+                        errors += 1
+                summary = {
+                    "total": len(items),
+                    "done": done,
+                    "skipped": skipped,
+                    "errors": errors,
+                    "items": results,
+                }
+                _log_apply(event, **summary)
+                out[kind] = summary
+        # только после записи clientsTable: при исключении xray_batch правки
+        # отбрасывает, и state.json не должен ссылаться на них
+        if dirty:
+            save_state(st)
+    finally:
+        _run_pmaps.reset(pmaps_token)
+        # Xray могли поменять даже без записи state — следующий отчёт считаем заново
+        invalidate_sync_collect()
+    return out
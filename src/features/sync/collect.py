@@ -1,26 +1,66 @@
 # src/features/sync/collect.py
 from __future__ import annotations
 from typing import Dict, Any, List
-import logging
+import logging, os, threading, time
 
-from core.state import load_state
+from core.state import load_state, state_revision
 from core import repo_xray as XR
 
 logger = logging.getLogger(__name__)
 
+# Короткий кэш снимка: несколько экранов/админов подряд получают один расчёт.
+# Ключ — время и ревизия state; apply-проходы берут force=True и сбрасывают кэш.
+SYNC_COLLECT_TTL_SEC = float(os.getenv("SYNC_COLLECT_TTL_SEC", "1"))
+_collect_cache: Dict[str, Any] = {"ts": 0.0, "rev": None, "snap": None}
+# держим на время расчёта: параллельные вызовы ждут первый
+_collect_lock = threading.Lock()
+
 
 def profiles_active(user: Dict[str, Any]) -> List[Dict[str, Any]]:
     return [p for p in user.get("profiles", []) if not p.get("deleted")]
 
 
-def sync_collect():
+def bot_client_index(clients: List[Dict[str, Any]]) -> Dict[tuple, Dict[str, Any]]:
+    """{(int tid, name): client} по клиентам source=bot — ключ как в apply."""
+    return {
+        (int(c.get("tid") or 0), c.get("name") or ""): c
+        for c in clients
+        if c.get("source") == "bot"
+    }
+
+
+def sync_collect(force: bool = False):
     """
     Снимок состояния:
     - users/profiles из state.json
     - клиенты Xray из server.json
 
     Учитываем только "своих" (source=bot), foreign считаем отдельно.
+    Результат кэшируется на SYNC_COLLECT_TTL_SEC; снимок общий — не мутировать.
+    force=True — всегда свежий расчёт.
     """
+    with _collect_lock:
+        rev = state_revision()
+        snap = _collect_cache["snap"]
+        if (
+            not force
+            and snap is not None
+            and _collect_cache["rev"] == rev
+            and (time.monotonic() - _collect_cache["ts"]) < SYNC_COLLECT_TTL_SEC
+        ):
+            return snap
+        snap = _sync_collect()
+        _collect_cache.update(ts=time.monotonic(), rev=state_revision(), snap=snap)
+        return snap
+
+
+def invalidate_sync_collect() -> None:
+    """Сбросить кэш снимка (после изменений в Xray/state)."""
+    with _collect_lock:
+        _collect_cache["snap"] = None
+
+
+def _sync_collect():
     st = load_state()
 
     # --- Xray ---
@@ -32,9 +72,12 @@ def sync_collect():
 
     xray_bot = [c for c in xlist if (c.get("source") == "bot")]
     xray_foreign = [c for c in xlist if (c.get("source") != "bot")]
-    xray_by_key = {(c.get("tid"), c.get("name")): c for c in xray_bot}
+    xray_by_key = bot_client_index(xray_bot)
 
     only_in_state, only_in_xray, diverged, suspended, active = [], [], [], [], []
+    # проход по state только строит индекс; раскладка по корзинам — на множествах
+    state_by_key: dict[tuple, dict] = {}
+    profiles_state = 0
     users = st.get("users", {})
     for tid_str, urec in users.items():
         try:
@@ -44,47 +87,47 @@ def sync_collect():
         for p in profiles_active(urec):
             if p.get("type") != "xray":
                 continue
-            key = (tid, p.get("name"))
-            present = key in xray_by_key
-            is_susp = bool(p.get("suspended"))
-            if present and not is_susp:
-                xr = xray_by_key.get(key, {})
-                diffs = []
-                st_uuid = (p.get("uuid") or "").strip()
-                xr_uuid = (xr.get("uuid") or "").strip()
-                if st_uuid and xr_uuid and st_uuid != xr_uuid:
-                    diffs.append("uuid")
-                st_flow = (p.get("flow") or "").strip()
-                xr_flow = (xr.get("flow") or "").strip()
-                if st_flow and xr_flow and st_flow != xr_flow:
-                    diffs.append("flow")
-                (diverged if diffs else active).append(
-                    {
-                        "tid": tid,
-                        "name": p["name"],
-                        **({"diffs": diffs} if diffs else {}),
-                    }
-                )
-            elif present and is_susp:
-                suspended.append({"tid": tid, "name": p["name"]})
-            elif not present and is_susp:
-                suspended.append({"tid": tid, "name": p["name"]})
-            else:
-                only_in_state.append({"tid": tid, "name": p["name"]})
+            state_by_key.setdefault((tid, p.get("name")), p)
+            profiles_state += 1
 
-    state_keys = set()
-    for tid_str, urec in users.items():
-        try:
-            tid = int(tid_str)
-        except Exception:
-            continue
-        for p in profiles_active(urec):
-            if p.get("type") == "xray":
-                state_keys.add((tid, p.get("name")))
+    state_keys = state_by_key.keys()
+    xray_keys = xray_by_key.keys()
+    suspended_keys = {k for k, p in state_by_key.items() if p.get("suspended")}
+    only_in_state_keys = state_keys - xray_keys - suspended_keys
+    only_in_xray_keys = xray_keys - state_keys
+    # uuid/flow сверяем только у общих и не приостановленных
+    common = (state_keys & xray_keys) - suspended_keys
+
+    # списки собираем в порядке state/Xray, как и раньше
+    for key, p in state_by_key.items():
+        tid = key[0]
+        if key in suspended_keys:
+            suspended.append({"tid": tid, "name": p["name"]})
+        elif key in only_in_state_keys:
+            only_in_state.append({"tid": tid, "name": p["name"]})
+        elif key in common:
+            xr = xray_by_key[key]
+            st_uuid = (p.get("uuid") or "").strip()
+            xr_uuid = (xr.get("uuid") or "").strip()
+            st_flow = (p.get("flow") or "").strip()
+            xr_flow = (xr.get("flow") or "").strip()
+            # основной случай — всё совпадает, список diffs не нужен
+            if st_uuid == xr_uuid and st_flow == xr_flow:
+                active.append({"tid": tid, "name": p["name"]})
+                continue
+            diffs = []
+            if st_uuid and xr_uuid and st_uuid != xr_uuid:
+                diffs.append("uuid")
+            if st_flow and xr_flow and st_flow != xr_flow:
+                diffs.append("flow")
+            if diffs:
+                diverged.append({"tid": tid, "name": p["name"], "diffs": diffs})
+            else:
+                active.append({"tid": tid, "name": p["name"]})
 
     for c in xray_bot:
         key = (int(c.get("tid") or 0), c.get("name") or "")
-        if key not in state_keys:
+        if key in only_in_xray_keys:
             only_in_xray.append({"tid": key[0], "name": key[1], "uuid": c.get("uuid")})
 
     counters = {
@@ -94,12 +137,7 @@ def sync_collect():
         "suspended": len(suspended),
         "active": len(active),
         "foreign": len(xray_foreign),
-        "profiles_state": sum(
-            1
-            for u in users.values()
-            for p in profiles_active(u)
-            if p.get("type") == "xray"
-        ),
+        "profiles_state": profiles_state,
         "clients_xray": len(xray_bot),
         "users": len(users),
     }
@@ -112,4 +150,6 @@ def sync_collect():
         "suspended": suspended,
         "active": active,
         "foreign": xray_foreign,
+        # индекс для apply-проходов, чтобы не перечитывать server.json на каждый элемент
+        "xray_by_key": xray_by_key,
     }
@@ -1,5 +1,8 @@
 # src/features/sync/render.py
 from __future__ import annotations
+from functools import lru_cache
+from itertools import chain, repeat
+from operator import itemgetter
 from typing import List
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 
@@ -17,10 +20,39 @@ SYNC_MODE_LABEL = {
 }
 
 
+# Нижние ряды клавиатуры /sync не зависят от фильтра/режима — собираем один раз
+_STATIC_ROWS = (
+    (
+        InlineKeyboardButton(
+            "🧩 Починить отсутствующие", callback_data="sync_apply_absent_all"
+        ),
+        InlineKeyboardButton("🧹 Убрать лишние", callback_data="sync_apply_extra_all"),
+    ),
+    (
+        InlineKeyboardButton(
+            "🧭 Обновить БД по Xray", callback_data="sync_apply_diverged_db_all"
+        ),
+        InlineKeyboardButton(
+            "🔁 Пересобрать в Xray по БД",
+            callback_data="sync_apply_diverged_xray_all",
+        ),
+    ),
+    (InlineKeyboardButton("🔄 Обновить", callback_data="sync_refresh"),),
+    (InlineKeyboardButton("🏠 В главное меню", callback_data="menu"),),
+)
+
+
+@lru_cache(maxsize=16)
 def build_sync_kb(active_filter: str, mode: str) -> InlineKeyboardMarkup:
+    """
+    Клавиатура отчёта /sync. Комбинаций (фильтр × режим) всего десяток,
+    разметка PTB неизменяема — отдаём один и тот же объект на комбинацию.
+    """
+
     def _radio(code: str) -> str:
         return ("• " if code == active_filter else "○ ") + SYNC_FILTERS[code]
 
+    other_mode = "compact" if mode == "detailed" else "detailed"
     rows = [
         [
             InlineKeyboardButton(_radio("all"), callback_data="sync_filter:all"),
@@ -39,44 +71,91 @@ def build_sync_kb(active_filter: str, mode: str) -> InlineKeyboardMarkup:
         ],
         [
             InlineKeyboardButton(
-                SYNC_MODE_LABEL["compact" if mode == "detailed" else "detailed"],
-                callback_data="sync_mode:"
-                + ("compact" if mode == "detailed" else "detailed"),
-            ),
-        ],
-        [
-            InlineKeyboardButton(
-                "🧩 Починить отсутствующие", callback_data="sync_apply_absent_all"
-            ),
-            InlineKeyboardButton(
-                "🧹 Убрать лишние", callback_data="sync_apply_extra_all"
-            ),
-        ],
-        [
-            InlineKeyboardButton(
-                "🧭 Обновить БД по Xray", callback_data="sync_apply_diverged_db_all"
-            ),
-            InlineKeyboardButton(
-                "🔁 Пересобрать в Xray по БД",
-                callback_data="sync_apply_diverged_xray_all",
+                SYNC_MODE_LABEL[other_mode],
+                callback_data="sync_mode:" + other_mode,
             ),
         ],
-        [
-            InlineKeyboardButton("🔄 Обновить", callback_data="sync_refresh"),
-        ],
-        [
-            InlineKeyboardButton("🏠 В главное меню", callback_data="menu"),
-        ],
+        *_STATIC_ROWS,
     ]
     return InlineKeyboardMarkup(rows)
 
 
+_get_tid_name = itemgetter("tid", "name")
+
+_TITLE_ABSENT = "<b>Отсутствуют в Xray (есть в БД):</b>\n"
+_TITLE_EXTRA = "<b>Есть в Xray (свои), отсутствуют в БД:</b>\n"
+_TITLE_DIVERGED = "<b>Расхождения:</b>\n"
+_TITLE_SUSPENDED = "<b>Приостановлены:</b>\n"
+_TITLE_ACTIVE = "<b>Активны:</b>\n"
+_TITLE_FOREIGN = (
+    "<b>Чужие клиенты Xray (не управляются ботом, действий не будет):</b>\n"
+)
+_SYNC_TAIL = (
+    "\n\n<i>Примечание:</i> чужие клиенты Xray (созданные не ботом) "
+    "учитываются только информативно и не затрагиваются автоматическими действиями."
+)
+
+
+class _Counters(dict):
+    """Счётчики для %-шаблонов: отсутствующий ключ — 0 (как c.get(k, 0))."""
+
+    def __missing__(self, key):
+        return 0
+
+
+_SYNC_HDR_TMPL = (
+    "<b>Синхронизация Xray ↔ БД</b>\n"
+    "• Всего пользователей в БД: <b>%(users)s</b>\n"
+    "• Профилей Xray в БД: <b>%(profiles_state)s</b>\n"
+    "• Клиентов Xray (свои): <b>%(clients_xray)s</b>\n"
+    "• Чужих клиентов Xray: <b>%(foreign)s</b>\n"
+    "\n"
+)
+_SYNC_HEADER_TMPL = (
+    "🧭 <b>Синхронизация (диагностика)</b>\n"
+    "Пользователей: <b>%(users)s</b>\n"
+    "Профилей (state.json): <b>%(profiles_state)s</b>\n"
+    "Клиентов Xray: <b>%(clients_xray)s</b>\n"
+    "Только в Xray: <b>%(only_in_xray)s</b>\n"
+    "Только в state.json: <b>%(only_in_state)s</b>\n"
+    "Расхождения: <b>%(diverged)s</b>\n"
+    "Приостановленные: <b>%(suspended)s</b>\n"
+    "Активные: <b>%(active)s</b>"
+)
+
+# фильтр -> (заголовок, корзина в снимке sync_collect)
+_FILTER_SECTIONS = {
+    "absent": (_TITLE_ABSENT, "only_in_state"),
+    "extra": (_TITLE_EXTRA, "only_in_xray"),
+    "diverged": (_TITLE_DIVERGED, "diverged"),
+    "suspended": (_TITLE_SUSPENDED, "suspended"),
+    "active": (_TITLE_ACTIVE, "active"),
+}
+
+
+def _append_pairs(append, items) -> None:
+    """Строки «• tid · name» через \n прямо в общий буфер; пусто — «—»."""
+    sep = ""
+    for i in items:
+        t, n = _get_tid_name(i)
+        append(sep)
+        append("• <code>")
+        append(str(t))
+        append("</code> · <b>")
+        append(str(n))
+        append("</b>")
+        sep = "\n"
+    if not sep:
+        append("—")
+
+
 def sync_render(data: dict, flt: str, mode: str) -> List[str]:
     """
     Рендер отчёта /sync.
     - В счётчиках показываем foreign.
     - В detailed режиме добавляем раздел с перечнем чужих записей (read-only).
     - Действия (кнопки) нигде не предлагаются для foreign.
+    Весь текст копится фрагментами в одном списке и склеивается один раз.
     """
     c = data.get("counters", {})
     only_in_state = data.get("only_in_state", [])
@@ -86,150 +165,130 @@ def sync_render(data: dict, flt: str, mode: str) -> List[str]:
     active = data.get("active", [])
     foreign = data.get("foreign", [])
 
-    hdr = (
-        "<b>Синхронизация Xray ↔ БД</b>\n"
-        f"• Всего пользователей в БД: <b>{c.get('users', 0)}</b>\n"
-        f"• Профилей Xray в БД: <b>{c.get('profiles_state', 0)}</b>\n"
-        f"• Клиентов Xray (свои): <b>{c.get('clients_xray', 0)}</b>\n"
-        f"• Чужих клиентов Xray: <b>{c.get('foreign', 0)}</b>\n"
-    )
-
-    lines = [hdr]
-
-    def fmt_pairs(items):
-        return (
-            "\n".join(
-                f"• <code>{i.get('tid',0)}</code> · <b>{i.get('name','')}</b>"
-                for i in items
-            )
-            or "—"
-        )
+    parts: list[str] = [_SYNC_HDR_TMPL % _Counters(c)]
+    append = parts.append
 
     if flt == "all":
-        body = []
-        body.append(
-            f"<b>Отсутствуют в Xray (есть в БД):</b>\n{fmt_pairs(only_in_state)}"
-        )
-        body.append(
-            f"<b>Есть в Xray (свои), отсутствуют в БД:</b>\n{fmt_pairs(only_in_xray)}"
-        )
+        # пустые «отсутствуют/лишние» показываем всегда, остальные — если есть
+        sections = [(_TITLE_ABSENT, only_in_state), (_TITLE_EXTRA, only_in_xray)]
         if diverged:
-            body.append(f"<b>Расхождения:</b>\n{fmt_pairs(diverged)}")
+            sections.append((_TITLE_DIVERGED, diverged))
         if suspended:
-            body.append(f"<b>Приостановлены:</b>\n{fmt_pairs(suspended)}")
+            sections.append((_TITLE_SUSPENDED, suspended))
         if active:
-            body.append(f"<b>Активны:</b>\n{fmt_pairs(active)}")
+            sections.append((_TITLE_ACTIVE, active))
+        sep = ""
+        for title, items in sections:
+            append(sep)
+            append(title)
+            _append_pairs(append, items)
+            sep = "\n\n"
 
         if mode == "detailed" and foreign:
-            fx = "\n".join(
-                f"• uuid=<code>{f.get('uuid','')}</code> · sni=<code>{f.get('sni','')}</code> · port=<code>{f.get('port','')}</code>"
-                for f in foreign
-            )
-            body.append(
-                "<b>Чужие клиенты Xray (не управляются ботом, действий не будет):</b>\n"
-                + fx
-            )
-
-        lines.append("\n\n".join(body))
-
-    elif flt == "absent":
-        lines.append(
-            "<b>Отсутствуют в Xray (есть в БД):</b>\n" + fmt_pairs(only_in_state)
-        )
-    elif flt == "extra":
-        lines.append(
-            "<b>Есть в Xray (свои), отсутствуют в БД:</b>\n" + fmt_pairs(only_in_xray)
-        )
-    elif flt == "diverged":
-        lines.append(
-            "<b>Расхождения:</b>\n" + (fmt_pairs(diverged) if diverged else "—")
-        )
-    elif flt == "suspended":
-        lines.append(
-            "<b>Приостановлены:</b>\n" + (fmt_pairs(suspended) if suspended else "—")
-        )
-    elif flt == "active":
-        lines.append("<b>Активны:</b>\n" + (fmt_pairs(active) if active else "—"))
+            append("\n\n")
+            append(_TITLE_FOREIGN)
+            fsep = ""
+            for f in foreign:
+                append(fsep)
+                append(
+                    f"• uuid=<code>{f.get('uuid','')}</code> · sni=<code>{f.get('sni','')}</code> · port=<code>{f.get('port','')}</code>"
+                )
+                fsep = "\n"
+
+    elif flt in _FILTER_SECTIONS:
+        title, key = _FILTER_SECTIONS[flt]
+        append(title)
+        _append_pairs(append, data.get(key, []))
     else:
-        lines.append("Неизвестный фильтр.")
+        append("Неизвестный фильтр.")
 
-    tail = (
-        "\n\n<i>Примечание:</i> чужие клиенты Xray (созданные не ботом) "
-        "учитываются только информативно и не затрагиваются автоматическими действиями."
-    )
-    text = "\n".join(lines) + tail
-    return [text]
+    append(_SYNC_TAIL)
+    return ["".join(parts)]
 
 
 # === helpers exported for bot.py (diagnostics UI pieces) ===
 
 def sync_header(c: dict) -> str:
-    return (
-        "🧭 <b>Синхронизация (диагностика)</b>\n"
-        f"Пользователей: <b>{c.get('users',0)}</b>\n"
-        f"Профилей (state.json): <b>{c.get('profiles_state',0)}</b>\n"
-        f"Клиентов Xray: <b>{c.get('clients_xray',0)}</b>\n"
-        f"Только в Xray: <b>{c.get('only_in_xray',0)}</b>\n"
-        f"Только в state.json: <b>{c.get('only_in_state',0)}</b>\n"
-        f"Расхождения: <b>{c.get('diverged',0)}</b>\n"
-        f"Приостановленные: <b>{c.get('suspended',0)}</b>\n"
-        f"Активные: <b>{c.get('active',0)}</b>"
-    )
+    return _SYNC_HEADER_TMPL % _Counters(c)
 
-def sync_filter_items(data: dict, flt: str) -> list[dict]:
-    if flt == "all":
-        # порядок: absent, extra, suspended, diverged, active
-        tagged = (
-            [dict(x, _tag="absent") for x in data.get("only_in_state", [])]
-            + [dict(x, _tag="extra") for x in data.get("only_in_xray", [])]
-            + [dict(x, _tag="suspended") for x in data.get("suspended", [])]
-            + [dict(x, _tag="diverged") for x in data.get("diverged", [])]
-            + [dict(x, _tag="active") for x in data.get("active", [])]
+class Tagged:
+    """
+    Элемент снимка sync_collect с пометкой корзины (_tag) без копирования dict.
+    Читается как словарь: it["name"], it.get("_tag").
+    """
+
+    __slots__ = ("d", "tag")
+
+    def __init__(self, d: dict, tag: str):
+        self.d = d
+        self.tag = tag
+
+    def __getitem__(self, k):
+        return self.tag if k == "_tag" else self.d[k]
+
+    def get(self, k, default=None):
+        return self.tag if k == "_tag" else self.d.get(k, default)
+
+    def __contains__(self, k) -> bool:
+        return k == "_tag" or k in self.d
+
+
+# фильтр -> [(корзина в снимке, тег)]; для "all" порядок: absent, extra, suspended, diverged, active
+_FILTER_TAGS = {
+    "absent": (("only_in_state", "absent"),),
+    "extra": (("only_in_xray", "extra"),),
+    "suspended": (("suspended", "suspended"),),
+    "diverged": (("diverged", "diverged"),),
+    "active": (("active", "active"),),
+}
+_FILTER_TAGS["all"] = tuple(
+    _FILTER_TAGS[k][0] for k in ("absent", "extra", "suspended", "diverged", "active")
+)
+
+
+def sync_filter_items(data: dict, flt: str) -> list[Tagged]:
+    # один итоговый список; обход корзин и обёртка в Tagged — на стороне C (chain/map)
+    return list(
+        chain.from_iterable(
+            map(Tagged, data.get(key, ()), repeat(tag))
+            for key, tag in _FILTER_TAGS.get(flt, ())
         )
-        return tagged
-    if flt == "absent":
-        return [dict(x, _tag="absent") for x in data.get("only_in_state", [])]
-    if flt == "extra":
-        return [dict(x, _tag="extra") for x in data.get("only_in_xray", [])]
-    if flt == "suspended":
-        return [dict(x, _tag="suspended") for x in data.get("suspended", [])]
-    if flt == "diverged":
-        return [dict(x, _tag="diverged") for x in data.get("diverged", [])]
-    if flt == "active":
-        return [dict(x, _tag="active") for x in data.get("active", [])]
-    return []
+    )
+
+
+_STATUS_LABELS = {
+    "active": "Активен ▶️",
+    "suspended": "Приостановлен ⏸",
+    "absent": "Отсутствует в Xray ⚠️",
+    "extra": "Лишний в Xray 🧩",
+}
+
 
 def sync_status_label(tag: str, diffs: list[str] | None = None) -> str:
-    if tag == "active":
-        return "Активен ▶️"
-    if tag == "suspended":
-        return "Приостановлен ⏸"
-    if tag == "absent":
-        return "Отсутствует в Xray ⚠️"
-    if tag == "extra":
-        return "Лишний в Xray 🧩"
     if tag == "diverged":
         return "Расхождение ❗" + (f" ({', '.join(diffs)})" if diffs else "")
-    return tag
+    return _STATUS_LABELS.get(tag, tag)
 
 def split_text_for_telegram(s: str, limit: int = 3500, safe_txt: str = "\u2060") -> list[str]:
     """
     Режет длинный текст на части < limit символов.
     Стараться резать по \n. Гарантирует, что список не пуст.
+    Идём по переводам строк через str.find и режем срезами только на границах
+    частей — без промежуточного списка строк.
     """
     s = s or safe_txt
-    if len(s) <= limit:
+    n = len(s)
+    if n <= limit:
         return [s]
-    parts, buf = [], []
-    total = 0
-    for line in s.splitlines(keepends=True):
-        ln = len(line)
-        if (total + ln) > limit and buf:
-            parts.append("".join(buf))
-            buf, total = [line], ln
-        else:
-            buf.append(line)
-            total += ln
-    if buf:
-        parts.append("".join(buf))
-    return parts or [safe_txt]
\ No newline at end of file
+    parts = []
+    start = pos = 0  # начало текущей части / начало очередной строки
+    while pos < n:
+        nl = s.find("\n", pos)
+        end = nl + 1 if nl != -1 else n
+        if (end - start) > limit and pos > start:
+            parts.append(s[start:pos])
+            start = pos
+        pos = end
+    if start < n:
+        parts.append(s[start:])
+    return parts or [safe_txt]
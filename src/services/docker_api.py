@@ -0,0 +1,235 @@
+"""
+Минимальный клиент Docker Engine API поверх http.client (без docker-py).
+
+Бот ходит в dockerd через docker-socket-proxy (DOCKER_HOST=tcp://...),
+поэтому exec и запись файлов можно делать одним HTTP-запросом вместо запуска
+docker CLI на каждый вызов. Соединение держим keep-alive на поток.
+"""
+import io, os, json, socket, struct, tarfile, threading, time
+import http.client
+from typing import Optional
+from urllib.parse import quote, urlsplit
+
+
+class DockerAPIError(Exception):
+    """Транспортная ошибка (нет связи с демоном/прокси) — повод уйти на CLI."""
+
+
+class DockerExecStartedError(Exception):
+    """
+    Связь оборвалась уже после /exec/{id}/start: команда могла выполниться,
+    поэтому повторять её (через CLI или ещё раз через API) нельзя.
+    """
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self._sock_path = path
+
+    def connect(self):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(self.timeout)
+        s.connect(self._sock_path)
+        self.sock = s
+
+
+def _docker_host() -> Optional[str]:
+    host = os.environ.get("DOCKER_HOST", "").strip()
+    if host:
+        return host
+    if os.path.exists("/var/run/docker.sock"):
+        return "unix:///var/run/docker.sock"
+    return None
+
+
+_local = threading.local()
+
+
+def _new_conn(timeout: float) -> http.client.HTTPConnection:
+    host = _docker_host()
+    if not host:
+        raise DockerAPIError("DOCKER_HOST is not set")
+    u = urlsplit(host)
+    if u.scheme == "unix":
+        return _UnixHTTPConnection(u.path, timeout)
+    if u.scheme in ("tcp", "http"):
+        return http.client.HTTPConnection(u.hostname, u.port or 2375, timeout=timeout)
+    raise DockerAPIError(f"unsupported DOCKER_HOST: {host}")
+
+
+def _request(method: str, path: str, body=None, *, timeout: float,
+             headers: Optional[dict] = None, dedicated: bool = False) -> tuple[int, bytes]:
+    """
+    Один запрос к API. dedicated=True — отдельное соединение (exec start
+    захватывает сокет и закрывает его по завершении команды).
+    Таймаут чтения пробрасывается как socket.timeout.
+    """
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body).encode("utf-8")
+        headers = {"Content-Type": "application/json", **(headers or {})}
+    for attempt in (0, 1):
+        conn = None if dedicated else getattr(_local, "conn", None)
+        fresh = conn is None
+        if fresh:
+            conn = _new_conn(timeout)
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            resp = conn.getresponse()
+            data = resp.read()
+        except socket.timeout:
+            conn.close()
+            _local.conn = None
+            raise
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            _local.conn = None
+            # keep-alive соединение могло протухнуть — одна попытка на свежем
+            if not fresh and attempt == 0:
+                continue
+            raise DockerAPIError(str(e) or e.__class__.__name__) from e
+        if dedicated or resp.will_close:
+            conn.close()
+            if not dedicated:
+                _local.conn = None
+        else:
+            _local.conn = conn
+        return resp.status, data
+    raise DockerAPIError("unreachable")
+
+
+def _api_error(status: int, data: bytes) -> str:
+    try:
+        msg = json.loads(data or b"{}").get("message") or ""
+    except ValueError:
+        msg = (data or b"").decode("utf-8", "replace").strip()
+    return f"Error response from daemon: {msg or f'HTTP {status}'}"
+
+
+def _demux(raw: bytes) -> tuple[bytes, bytes]:
+    """Разбор мультиплексированного потока exec (8-байтовые заголовки кадров)."""
+    out, err = [], []
+    pos, n = 0, len(raw)
+    while pos + 8 <= n:
+        kind, size = raw[pos], struct.unpack_from(">I", raw, pos + 4)[0]
+        chunk = raw[pos + 8:pos + 8 + size]
+        (err if kind == 2 else out).append(chunk)
+        pos += 8 + size
+    return b"".join(out), b"".join(err)
+
+
+def exec_run(container: str, argv: list[str], *, timeout: float) -> tuple[int, str, str]:
+    """
+    Аналог `docker exec [-i] <ctr> <argv...>`: возвращает (rc, stdout, stderr).
+    Ошибки демона (нет контейнера и т.п.) — rc=1 и текст как у CLI.
+    Нет связи до запуска — DockerAPIError, после запуска — DockerExecStartedError;
+    таймаут — socket.timeout.
+    """
+    deadline = time.monotonic() + timeout
+    cfg = {"AttachStdout": True, "AttachStderr": True, "Tty": False, "Cmd": argv}
+    status, data = _request("POST", f"/containers/{quote(container, safe='')}/exec",
+                            cfg, timeout=timeout)
+    if status != 201:
+        return 1, "", _api_error(status, data)
+    exec_id = json.loads(data)["Id"]
+
+    left = max(0.1, deadline - time.monotonic())
+    try:
+        status, raw = _request("POST", f"/exec/{exec_id}/start",
+                               {"Detach": False, "Tty": False}, timeout=left, dedicated=True)
+        if status != 200:
+            return 1, "", _api_error(status, raw)
+        out, err = _demux(raw)
+
+        left = max(0.1, deadline - time.monotonic())
+        status, data = _request("GET", f"/exec/{exec_id}/json", timeout=left)
+        rc = 1
+        if status == 200:
+            code = json.loads(data).get("ExitCode")
+            rc = 1 if code is None else int(code)
+    except (DockerAPIError, ValueError) as e:
+        raise DockerExecStartedError(str(e) or e.__class__.__name__) from e
+    return (
+        rc,
+        out.decode("utf-8", "replace").strip(),
+        err.decode("utf-8", "replace").strip(),
+    )
+
+
+def inspect_container(container: str, *, timeout: float) -> Optional[dict]:
+    """GET /containers/<id>/json по keep-alive соединению; None — контейнера нет."""
+    status, data = _request("GET", f"/containers/{quote(container, safe='')}/json",
+                            timeout=timeout)
+    if status == 404:
+        return None
+    if status != 200:
+        raise DockerAPIError(_api_error(status, data))
+    return json.loads(data)
+
+
+def put_file(container: str, path: str, content: bytes, *, timeout: float,
+             mode: int = 0o644) -> tuple[int, str]:
+    """
+    Кладёт файл в контейнер одним tar-архивом (PUT /archive), как docker cp.
+    Возвращает (rc, err); каталог назначения должен существовать.
+    """
+    dirname, name = os.path.split(path)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        info.mode = mode
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(content))
+    status, data = _request(
+        "PUT",
+        f"/containers/{quote(container, safe='')}/archive?path={quote(dirname or '/', safe='')}",
+        buf.getvalue(),
+        timeout=timeout,
+        headers={"Content-Type": "application/x-tar"},
+    )
+    if status != 200:
+        return 1, _api_error(status, data)
+    return 0, ""
+
+
+def wait_container_event(container: str, actions: tuple[str, ...], *,
+                         since: float, until: float) -> Optional[str]:
+    """
+    Ждёт событие контейнера из /events (push от демона вместо опроса inspect).
+    since — с какого момента учитывать события (ловим и уже случившиеся),
+    until — демон сам закроет поток в этот момент.
+    Возвращает Action пойманного события или None, если до until ничего не было.
+    """
+    filters = json.dumps({
+        "type": ["container"],
+        "container": [container],
+        "event": ["start", "health_status"],
+    })
+    path = f"/events?since={int(since)}&until={int(until) + 1}&filters={quote(filters, safe='')}"
+    conn = _new_conn(max(1.0, until - time.time()) + 5)
+    try:
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            if resp.status != 200:
+                raise DockerAPIError(_api_error(resp.status, resp.read()))
+            while True:
+                line = resp.readline()
+                if not line:
+                    return None
+                try:
+                    action = json.loads(line).get("Action") or ""
+                except ValueError:
+                    continue
+                if action in actions:
+                    return action
+        except socket.timeout:
+            return None
+        except (OSError, http.client.HTTPException) as e:
+            raise DockerAPIError(str(e) or e.__class__.__name__) from e
+    finally:
+        conn.close()
@@ -1,9 +1,10 @@
 # /opt/awgbot/src/logger_setup.py
-import os, re, json, gzip, logging, logging.handlers
-from datetime import datetime
+import os, re, gzip, time, shutil, logging, logging.handlers
 from pathlib import Path
 from typing import Any
 
+from services.util import json_dumps_compact
+
 LOG_DIR = Path("/app/data/logs")
 LOG_DIR.mkdir(parents=True, exist_ok=True)
 LOG_PATH = LOG_DIR / "bot.log"
@@ -11,22 +12,39 @@ LOG_PATH = LOG_DIR / "bot.log"
 _LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 LEVEL = getattr(logging, _LEVEL, logging.INFO)
 
-# соберём известные секреты: всё из ENV, чьи ключи содержат токен/секрет/пароль/ключ/pbk
-_SECRET_VALUES: list[str] = []
+# соберём известные секреты: всё из ENV, чьи ключи содержат токен/секрет/пароль/ключ/pbk.
+# Без повторов, без хвостовых пробелов/переводов строк (из env-файлов), длинные первыми —
+# чтобы короткий секрет-префикс не маскировал длинный частично
 _secret_key_re = re.compile(r"(TOKEN|SECRET|PASSWORD|PASS|API_KEY|PBK)", re.I)
-for k, v in os.environ.items():
-    if v and _secret_key_re.search(k):
-        _SECRET_VALUES.append(str(v))
+_SECRET_VALUES: tuple[str, ...] = tuple(
+    sorted(
+        {
+            v.strip()
+            for k, v in os.environ.items()
+            if v and v.strip() and _secret_key_re.search(k)
+        },
+        key=len,
+        reverse=True,
+    )
+)
+
+# одна альтернация на все секреты (порядок _SECRET_VALUES уже «длинные первыми»)
+_SECRET_RE = (
+    re.compile("|".join(re.escape(v) for v in _SECRET_VALUES))
+    if _SECRET_VALUES
+    else None
+)
 
 def _mask(s: str) -> str:
-    # заменяем точные вхождения значений на ***
-    for val in _SECRET_VALUES:
-        if val and val in s:
-            s = s.replace(val, "***")
-    return s
+    # заменяем точные вхождения значений на *** — один проход по строке
+    if _SECRET_RE is None:
+        return s
+    return _SECRET_RE.sub("***", s)
 
 def _mask_obj(obj: Any) -> Any:
     # рекурсивно маскируем строки внутри dict/list
+    if _SECRET_RE is None:
+        return obj  # секретов нет — нечего и пересобирать
     if isinstance(obj, str):
         return _mask(obj)
     if isinstance(obj, dict):
@@ -35,9 +53,20 @@ def _mask_obj(obj: Any) -> Any:
         return [_mask_obj(x) for x in obj]
     return obj
 
+# метка времени с точностью до секунды: пересчитываем только при смене секунды
+_ts_cache: list = [-1, ""]
+
+def _utc_ts(created: float) -> str:
+    sec = int(created)
+    if _ts_cache[0] != sec:
+        _ts_cache[1] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(sec))
+        _ts_cache[0] = sec
+    return _ts_cache[1]
+
 class JsonFormatter(logging.Formatter):
     def format(self, record: logging.LogRecord) -> str:
-        ts = datetime.utcnow().isoformat(timespec="seconds") + "Z"
+        # время записи берём из record.created, без объектов datetime
+        ts = _utc_ts(record.created)
         # базовый payload
         payload: dict[str, Any] = {
             "ts": ts,
@@ -48,27 +77,66 @@ class JsonFormatter(logging.Formatter):
             "func": record.funcName,
         }
         # если msg — словарь, сольём; иначе как строку
-        msg = record.getMessage()
+        # (getMessage() для словаря не зовём — это лишний str(dict))
         if isinstance(record.msg, dict):
             payload.update(record.msg)  # уже структурный
         else:
-            payload["msg"] = msg
+            payload["msg"] = record.getMessage()
         # исключение -> stack
         if record.exc_info:
             payload["exc"] = self.formatException(record.exc_info)
         # маскируем секреты в payload
-        payload = _mask_obj(payload)
-        return json.dumps(payload, ensure_ascii=False)
+        if _SECRET_RE is not None:
+            payload = _mask_obj(payload)
+        return json_dumps_compact(payload)
+
+# архив bot.log: <дата>[.N][.gz], N — ротация по размеру в пределах суток
+_ARCHIVE_RE = re.compile(r"(\d{4}-\d{2}-\d{2})(?:\.\d+)?(?:\.gz)?")
 
 class GzipTimedRotator(logging.handlers.TimedRotatingFileHandler):
-    """Ротация раз в сутки с автосжатием .gz и хранением N файлов."""
-    def __init__(self, filename, when="midnight", interval=1, backupCount=14, encoding="utf-8"):
+    """
+    Ротация раз в сутки с автосжатием .gz; backupCount — сколько суток хранить.
+    maxBytes > 0 — дополнительно ротируем по размеру (в пределах суток
+    архивы получают суффикс .1, .2, ...; при очистке считаются одним днём).
+    """
+    def __init__(self, filename, when="midnight", interval=1, backupCount=14, encoding="utf-8", maxBytes=0):
         super().__init__(filename, when=when, interval=interval, backupCount=backupCount, encoding=encoding, utc=True)
+        self.maxBytes = maxBytes
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        if self.maxBytes > 0:
+            if self.stream is None:
+                self.stream = self._open()
+            if self.stream.tell() >= self.maxBytes:
+                return True
+        return False
+    def getFilesToDelete(self):
+        # стандартная реализация считает файлы, а не сутки: загруженный день
+        # с десятком .N-архивов вытеснил бы предыдущие дни целиком
+        dir_name, base = os.path.split(self.baseFilename)
+        prefix = base + "."
+        by_day: dict[str, list[str]] = {}
+        for fn in os.listdir(dir_name):
+            if fn.startswith(prefix):
+                m = _ARCHIVE_RE.fullmatch(fn[len(prefix):])
+                if m:
+                    by_day.setdefault(m.group(1), []).append(os.path.join(dir_name, fn))
+        days = sorted(by_day)
+        if len(days) <= self.backupCount:
+            return []
+        return [p for d in days[: len(days) - self.backupCount] for p in by_day[d]]
     def rotate(self, source, dest):
+        # не затираем архив, уже созданный за эти сутки ротацией по размеру
+        base, n = dest, 0
+        while os.path.exists(dest + ".gz"):
+            n += 1
+            dest = f"{base}.{n}"
         # переименовали — теперь сжимаем старый файл в .gz
         try:
             with open(source, "rb") as f_in, gzip.open(dest + ".gz", "wb") as f_out:
-                f_out.writelines(f_in)
+                # блоками по 1 MiB, а не построчно
+                shutil.copyfileobj(f_in, f_out, 1 << 20)
             os.remove(source)
         except Exception:
             # в крайнем случае — обычное переименование
@@ -77,6 +145,30 @@ class GzipTimedRotator(logging.handlers.TimedRotatingFileHandler):
             except Exception:
                 pass
 
+_JSON_FMT = JsonFormatter()
+
+# Хендлеры общие для всех логгеров: несколько ротаторов на один bot.log
+# переименовывали бы файл друг у друга, и остальные писали бы в удалённый inode
+_file_handler: logging.Handler | None = None
+_stream_handler: logging.Handler | None = None
+
+def _shared_handlers() -> tuple[logging.Handler, logging.Handler]:
+    global _file_handler, _stream_handler
+    if _file_handler is None:
+        # один файловый хендлер: сутки или 1MB, что раньше, с gzip -> JSON;
+        # храним 14 суток (см. GzipTimedRotator.getFilesToDelete)
+        fh = GzipTimedRotator(LOG_PATH, backupCount=14, maxBytes=1_000_000)
+        fh.setFormatter(_JSON_FMT)
+        fh.setLevel(LEVEL)
+        _file_handler = fh
+    if _stream_handler is None:
+        # поток в stdout для docker logs -> краткий человекочитаемый
+        sh = logging.StreamHandler()
+        sh.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+        sh.setLevel(LEVEL)
+        _stream_handler = sh
+    return _file_handler, _stream_handler
+
 def get_logger(name: str = "awgbot") -> logging.Logger:
     # жёсткая защита от дублей: чистим хендлеры и у текущего логгера, и у корневого
     root = logging.getLogger()
@@ -91,24 +183,7 @@ def get_logger(name: str = "awgbot") -> logging.Logger:
 
     logger.setLevel(LEVEL)
 
-    # размерная ротация (1MB x 5) -> JSON
-    size_handler = logging.handlers.RotatingFileHandler(
-        LOG_PATH, maxBytes=1_000_000, backupCount=5, encoding="utf-8"
-    )
-    size_handler.setFormatter(JsonFormatter())
-    size_handler.setLevel(LEVEL)
-
-    # суточная ротация с gzip (14 суток) -> JSON
-    time_handler = GzipTimedRotator(LOG_PATH, backupCount=14)
-    time_handler.setFormatter(JsonFormatter())
-    time_handler.setLevel(LEVEL)
-
-    # поток в stdout для docker logs -> краткий человекочитаемый
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
-    stream_handler.setLevel(LEVEL)
-
-    logger.addHandler(size_handler)
-    logger.addHandler(time_handler)
+    file_handler, stream_handler = _shared_handlers()
+    logger.addHandler(file_handler)
     logger.addHandler(stream_handler)
     return logger
\ No newline at end of file
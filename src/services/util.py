@@ -1,7 +1,14 @@
-import os, subprocess, uuid, time, re, logging
+import os, subprocess, time, re, socket, json, logging
 from datetime import datetime, UTC
 from typing import Optional, Union, List
 
+from services import docker_api
+
+try:
+    import orjson
+except ImportError:  # без orjson — стандартный json (медленнее на больших таблицах)
+    orjson = None
+
 logger = logging.getLogger("awgbot")
 
 # ====== ПУТИ ХРАНЕНИЯ ======
@@ -13,6 +20,9 @@ XRAY_CONTAINER     = os.environ.get("XRAY_CONTAINER", "amnezia-xray")
 XRAY_CONFIG_PATH   = os.environ.get("XRAY_CONFIG_PATH", "/opt/amnezia/xray/server.json")
 XRAY_INBOUND_INDEX = int(os.environ.get("XRAY_INBOUND_INDEX", "0"))
 XRAY_CONNECT_HOST  = os.environ.get("XRAY_CONNECT_HOST", "")
+# Каталог конфига Xray (dirname XRAY_CONFIG_PATH), примонтированный в контейнер бота.
+# Если задан — server.json/clientsTable читаем и пишем напрямую, без docker exec.
+XRAY_HOST_DIR      = os.environ.get("XRAY_HOST_DIR", "")
 
 # ====== AWG ENV ======
 AWG_CONTAINER    = os.environ.get("AWG_CONTAINER", "amnezia-awg")
@@ -27,6 +37,8 @@ DOCKER_EXEC_RETRIES     = int(os.environ.get("DOCKER_EXEC_RETRIES", "1"))
 DOCKER_EXEC_RETRY_SECS  = float(os.environ.get("DOCKER_EXEC_RETRY_SECS", "2"))
 DOCKER_RESTART_TIMEOUT  = int(os.environ.get("DOCKER_RESTART_TIMEOUT", "30"))
 DOCKER_UP_TIMEOUT       = int(os.environ.get("DOCKER_UP_TIMEOUT", "30"))
+# 1 — exec/запись файлов через docker CLI (как раньше), без прямых вызовов Engine API
+DOCKER_EXEC_CLI         = os.environ.get("DOCKER_EXEC_CLI", "0") == "1"
 
 # ========= базовые утилиты =========
 def run(cmd: list[str], timeout: int = 30) -> str:
@@ -53,15 +65,83 @@ def run(cmd: list[str], timeout: int = 30) -> str:
     logger.debug({"event": "run_ok", "cmd": cmd, "t": duration})
     return out
 
-# Ошибки, на которых имеет смысл попробовать повтор
-_RETRYABLE_ERR_RE = re.compile(
-    r"(i/o timeout|context deadline exceeded|cannot connect to the docker daemon|"
-    r"HTTP .* error|OCI runtime .* failed|EOF)",
-    re.IGNORECASE
+# Ошибки, на которых имеет смысл попробовать повтор.
+# Литералы ищем подстрокой в lower(); шаблоны «A .* B» — регуляркой и только
+# если обе части вообще встречаются в тексте.
+_RETRYABLE_NEEDLES = (
+    "i/o timeout",
+    "context deadline exceeded",
+    "cannot connect to the docker daemon",
+    "eof",
 )
+_RETRYABLE_PAIRS = (("http ", " error"), ("oci runtime ", " failed"))
+_RETRYABLE_PAIR_RE = re.compile(r"(HTTP .* error|OCI runtime .* failed)", re.IGNORECASE)
 
 def _should_retry(errmsg: str) -> bool:
-    return bool(_RETRYABLE_ERR_RE.search(errmsg or ""))
+    if not errmsg:
+        return False
+    e = errmsg.lower()
+    if any(n in e for n in _RETRYABLE_NEEDLES):
+        return True
+    if any(a in e and b in e for a, b in _RETRYABLE_PAIRS):
+        return bool(_RETRYABLE_PAIR_RE.search(errmsg))
+    return False
+
+# Engine API недоступен (нет DOCKER_HOST, прокси лежит) — минуту работаем через CLI
+DOCKER_API_COOLDOWN_SEC = 60.0
+_api_retry_at = 0.0
+
+
+def _api_enabled() -> bool:
+    return not DOCKER_EXEC_CLI and time.monotonic() >= _api_retry_at
+
+
+def _disable_api(err: str) -> None:
+    global _api_retry_at
+    _api_retry_at = time.monotonic() + DOCKER_API_COOLDOWN_SEC
+    logger.warning({"event": "docker_api_unavailable", "err": err, "fallback": "cli"})
+
+
+def _exec_once(
+    container: str,
+    exec_argv: list[str],
+    argv: list[str],
+    timeout: int,
+    input: Optional[bytes] = None,
+) -> tuple[int, str, str]:
+    """
+    Один запуск команды: через Engine API (без старта docker CLI), а если API
+    недоступен — через `docker exec`. Таймаут — subprocess.TimeoutExpired в обоих случаях.
+    input (stdin для команды) — только через CLI: exec API здесь без stdin.
+    На CLI уходим, только если API отказал до запуска команды; обрыв после
+    запуска — RuntimeError без повтора (mv, генерация ключей и т.п. не идемпотентны).
+    """
+    if input is None and _api_enabled():
+        try:
+            return docker_api.exec_run(container, exec_argv, timeout=timeout)
+        except socket.timeout:
+            raise subprocess.TimeoutExpired(argv, timeout)
+        except docker_api.DockerExecStartedError as e:
+            _disable_api(str(e))
+            raise RuntimeError(f"docker exec {container}: connection lost after start: {e}") from e
+        except docker_api.DockerAPIError as e:
+            _disable_api(str(e))
+    if input is None:
+        stdin_kw = {"stdin": subprocess.DEVNULL}
+    else:
+        stdin_kw = {"input": input}
+    p = subprocess.run(
+        argv,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        timeout=timeout,
+        **stdin_kw,
+    )
+    return (
+        p.returncode,
+        (p.stdout or b"").decode("utf-8", "replace").strip(),
+        (p.stderr or b"").decode("utf-8", "replace").strip(),
+    )
 
 def docker_exec(
     container: str,
@@ -70,35 +150,31 @@ def docker_exec(
     timeout: int = DOCKER_EXEC_TIMEOUT,
     retries: int = DOCKER_EXEC_RETRIES,
     retry_delay: float = DOCKER_EXEC_RETRY_SECS,
+    input: Optional[str] = None,
 ) -> tuple[int, str, str]:
     """
     Запускает команду внутри контейнера и возвращает (rc, stdout, stderr).
     - cmd: list → исполняется как argv без шелла: docker exec -i <ctr> <argv...>
     - cmd: str  → исполняется через оболочку контейнера: sh -lc "<cmd>"
+    - input: текст на stdin команды (UTF-8)
     Не выбрасывает исключение при rc!=0; повторяет попытку на ретраибл-ошибках.
+    Таймаут — subprocess.TimeoutExpired; обрыв связи с API после запуска
+    команды — RuntimeError (исход неизвестен, повтора нет).
     """
+    if isinstance(cmd, list):
+        exec_argv = list(cmd)
+    elif isinstance(cmd, str):
+        exec_argv = ["sh", "-lc", cmd]
+    else:
+        raise TypeError("cmd must be str or list[str]")
+    argv = ["docker", "exec", "-i", container, *exec_argv]
+    cmd_repr = cmd
+    stdin_data = None if input is None else input.encode("utf-8")
+
     last_err = ""
     for attempt in range(retries + 1):
-        if isinstance(cmd, list):
-            argv = ["docker", "exec", "-i", container, *cmd]
-            cmd_repr = cmd
-        elif isinstance(cmd, str):
-            argv = ["docker", "exec", "-i", container, "sh", "-lc", cmd]
-            cmd_repr = cmd
-        else:
-            raise TypeError("cmd must be str or list[str]")
-
         t0 = time.monotonic()
-        p = subprocess.run(
-            argv,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            timeout=timeout,
-        )
-        rc = p.returncode
-        out = (p.stdout or "").strip()
-        err = (p.stderr or "").strip()
+        rc, out, err = _exec_once(container, exec_argv, argv, timeout, stdin_data)
         dt = round(time.monotonic() - t0, 2)
 
         if rc == 0:
@@ -115,36 +191,153 @@ def docker_exec(
         logger.warning({"event": "docker_exec_failed", "container": container, "cmd": cmd_repr, "rc": rc, "err": last_err, "t": dt})
         return rc, out, err
 
+_BATCH_SEP = "__AWGBOT_SEP__"
+_BATCH_SEP_RE = re.compile(r"(?:^|\n)" + _BATCH_SEP + r" (\d+)(?:\n|$)")
+
+def docker_exec_batch(
+    container: str,
+    cmds: List[str],
+    *,
+    timeout: int = DOCKER_EXEC_TIMEOUT,
+) -> tuple[int, list[tuple[int, str]], str]:
+    """
+    Несколько shell-команд одним docker exec (один вызов вместо N).
+    Команды идут подряд в одном sh (переменные видны следующим), после каждой
+    печатается разделитель с её кодом возврата.
+    Возвращает (rc, [(rc_i, stdout_i), ...], stderr); rc != 0 — сбой самого exec,
+    тогда недостающие результаты заполнены (rc, "").
+    """
+    script = "".join(f"{c}\nprintf '\\n{_BATCH_SEP} %s\\n' \"$?\"\n" for c in cmds)
+    rc, out, err = docker_exec(container, ["sh", "-lc", script], timeout=timeout)
+    results: list[tuple[int, str]] = []
+    pos = 0
+    for m in _BATCH_SEP_RE.finditer(out):
+        results.append((int(m.group(1)), out[pos:m.start()].strip()))
+        pos = m.end()
+    if len(results) < len(cmds):
+        rc = rc or 1
+        results.extend([(rc, "")] * (len(cmds) - len(results)))
+    return rc, results[:len(cmds)], err
+
+def host_path_for(container: str, path: str) -> Optional[str]:
+    """
+    Путь к файлу контейнера на смонтированном в бот томе (XRAY_HOST_DIR) или None.
+    Только для файлов из каталога XRAY_CONFIG_PATH контейнера Xray.
+    """
+    if not XRAY_HOST_DIR or container != XRAY_CONTAINER:
+        return None
+    if os.path.dirname(path) != os.path.dirname(XRAY_CONFIG_PATH):
+        return None
+    return os.path.join(XRAY_HOST_DIR, os.path.basename(path))
+
+def _write_host_file_atomic(host_path: str, content: str) -> None:
+    """tmp + fsync + os.replace рядом с файлом; права берём у прежнего файла."""
+    tmp = f"{host_path}.tmp"
+    try:
+        mode = os.stat(host_path).st_mode & 0o7777
+    except OSError:
+        mode = 0o644
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        os.write(fd, content.encode("utf-8"))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.chmod(tmp, mode)
+    os.replace(tmp, host_path)
+
 def docker_read_file(container: str, path: str, timeout: int = DOCKER_EXEC_TIMEOUT) -> str:
+    hp = host_path_for(container, path)
+    if hp:
+        try:
+            with open(hp, encoding="utf-8") as f:
+                return f.read().strip()
+        except OSError as e:
+            raise RuntimeError(f"failed to read {path}: {e}")
     rc, out, err = docker_exec(container, ["sh", "-lc", f"cat {shq(path)}"], timeout=timeout)
     if rc != 0:
         raise RuntimeError(err or f"failed to read {path}")
     return out
 
-def docker_write_file_atomic(container: str, path: str, content: str, timeout: int = 15):
+def docker_write_file_atomic(container: str, path: str, content: str, timeout: int = 15,
+                             stat_fmt: Optional[str] = None) -> Optional[str]:
     """
-    Надёжная запись файла в контейнер: docker cp -> mv.
+    Надёжная запись файла в контейнер: PUT /archive -> mv, а без Engine API
+    (или если PUT отказал, например нет каталога) — один `docker exec -i`
+    (mkdir -p && cat > tmp && mv) с содержимым на stdin.
     Гарантируем наличие директории и логируем успешную запись.
+    stat_fmt — тем же exec вернуть `stat -c <fmt>` нового файла (для кэшей по подписи);
+    для host-пути и без stat_fmt возвращает None.
     """
-    host_tmp = f"/tmp/awgbot_{os.getpid()}_{uuid.uuid4().hex}.tmp"
-    os.makedirs(os.path.dirname(host_tmp), exist_ok=True)
-    with open(host_tmp, "w", encoding="utf-8") as f:
-        f.write(content)
-    try:
-        run(["docker", "cp", host_tmp, f"{container}:{path}.tmp"], timeout=timeout)
-        rc, _, err = docker_exec(
+    hp = host_path_for(container, path)
+    if hp:
+        _write_host_file_atomic(hp, content)
+        logger.info({"event": "docker_write_atomic", "container": container, "path": path, "host": True})
+        return None
+    tmp_path = f"{path}.tmp"
+    via_cli = not _api_enabled()
+    if not via_cli:
+        try:
+            rc, err = docker_api.put_file(container, tmp_path, content.encode("utf-8"), timeout=timeout)
+        except socket.timeout:
+            raise RuntimeError(f"Timeout {timeout}s: put_archive {container}:{tmp_path}")
+        except docker_api.DockerAPIError as e:
+            _disable_api(str(e))
+            via_cli = True
+        else:
+            if rc != 0:
+                # чаще всего нет каталога (PUT /archive его не создаёт) — CLI-путь
+                # сделает mkdir -p и запишет файл тем же exec
+                logger.info({"event": "docker_put_archive_failed", "container": container, "path": path, "err": err})
+                via_cli = True
+    if via_cli:
+        # без host-tmp и docker cp: запись, mkdir и mv — одним exec;
+        # каталог считаем здесь, а не $(dirname ...) — лишний fork в контейнере
+        script = (
+            f"mkdir -p {shq(os.path.dirname(path) or '/')} && cat > {shq(tmp_path)} && "
+            f"mv {shq(tmp_path)} {shq(path)}"
+        )
+        if stat_fmt:
+            script += f" && stat -c {shq(stat_fmt)} {shq(path)}"
+        rc, out, err = docker_exec(container, ["sh", "-lc", script], timeout=timeout, input=content)
+    elif stat_fmt:
+        rc, out, err = docker_exec(
             container,
-            ["sh", "-lc", f"mkdir -p $(dirname {shq(path)}) && mv {shq(path)}.tmp {shq(path)}"],
+            ["sh", "-c", 'mv "$1" "$2" && stat -c "$3" "$2"', "sh", tmp_path, path, stat_fmt],
             timeout=timeout,
         )
-        if rc != 0:
-            raise RuntimeError(err or "docker mv failed")
-        logger.info({"event": "docker_write_atomic", "container": container, "path": path})
-    finally:
+    else:
+        # put_archive уже положил tmp в этот каталог — mkdir и оболочка не нужны
+        rc, out, err = docker_exec(container, ["mv", tmp_path, path], timeout=timeout)
+    if rc != 0:
+        raise RuntimeError(err or "docker mv failed")
+    logger.info({"event": "docker_write_atomic", "container": container, "path": path})
+    return (out.strip() or None) if stat_fmt else None
+
+def json_dumps_pretty(obj) -> str:
+    """
+    JSON с отступом 2 и UTF-8 как есть (как json.dumps(..., ensure_ascii=False, indent=2)).
+    json с indent всегда идёт чистым Python — orjson на порядок быстрее на clientsTable.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:  # orjson.JSONEncodeError: int > 64 бит и т.п.
+            pass
+    return json.dumps(obj, ensure_ascii=False, indent=2)
+
+# json.dumps с нестандартными опциями создаёт JSONEncoder на каждый вызов —
+# для запасного пути держим один готовый
+_compact_std_encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+def json_dumps_compact(obj) -> str:
+    """JSON без пробелов, UTF-8 как есть (строки логов, обёртка vpn://)."""
+    if orjson is not None:
         try:
-            os.remove(host_tmp)
-        except OSError:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:  # orjson.JSONEncodeError: неподдерживаемый тип и т.п.
             pass
+    return _compact_std_encode(obj)
 
 def shq(s: str) -> str:
     return "'" + (s or "").replace("'", "'\"'\"'") + "'"
@@ -152,13 +345,21 @@ def shq(s: str) -> str:
 def now_iso() -> str:
     return datetime.now(UTC).isoformat(timespec="seconds")
 
+# Бинарь в контейнере не меняется за время жизни бота — проверяем один раз.
+# Кэшируем только определённый ответ (rc == 0), сбой exec перепроверим в следующий раз.
+_awg_bin: Optional[str] = None
+
 def get_awg_bin() -> str:
+    global _awg_bin
+    if _awg_bin is not None:
+        return _awg_bin
     try:
         rc, out, _ = docker_exec(
             AWG_CONTAINER, ["sh", "-lc", f"command -v {shq(AWG_BIN)} >/dev/null && echo OK || echo NO"],
         )
-        if rc == 0 and out.strip() == "OK":
-            return AWG_BIN
+        if rc == 0:
+            _awg_bin = AWG_BIN if out.strip() == "OK" else "wg"
+            return _awg_bin
     except Exception:
         pass
     return "wg"
@@ -169,6 +370,18 @@ def _inspect_state(container: str, timeout: int = 6) -> tuple[bool, Optional[str
     Возвращает (running, health_status|None)
     health_status: 'healthy' | 'unhealthy' | 'starting' | None (если healthcheck не настроен)
     """
+    if _api_enabled():
+        try:
+            info = docker_api.inspect_container(container, timeout=timeout)
+        except docker_api.DockerAPIError as e:
+            _disable_api(str(e))
+        except Exception:
+            return False, None
+        else:
+            st = (info or {}).get("State") or {}
+            health = (st.get("Health") or {}).get("Status") or None
+            return bool(st.get("Running")), health
+
     fmt = "{{.State.Running}} {{if .State.Health}}{{.State.Health.Status}}{{end}}"
     try:
         out = run(["docker", "inspect", "-f", fmt, container], timeout=timeout) or ""
@@ -193,13 +406,33 @@ def docker_restart(
     Синхронный рестарт контейнера с ожиданием Up [/healthy] и одним повтором при неудаче.
     Блокирует поток вызвавшего кода до завершения попытки.
     """
-    def _wait() -> bool:
+    def _ready(running: bool, health: Optional[str]) -> bool:
+        if running and (not wait_healthy or health == "healthy"):
+            logger.info({"event": "docker_up", "container": container, "health": health})
+            return True
+        return False
+
+    def _wait(since: float) -> bool:
         deadline = time.time() + up_timeout
+        # docker restart возвращается уже после старта — часто ждать нечего
+        if _ready(*_inspect_state(container)):
+            return True
+        if _api_enabled():
+            # ждём событие start / health_status: healthy, а не опрашиваем inspect раз в секунду
+            want = ("health_status: healthy",) if wait_healthy else ("start",)
+            try:
+                got = docker_api.wait_container_event(container, want, since=since, until=deadline)
+            except docker_api.DockerAPIError as e:
+                _disable_api(str(e))
+            else:
+                if got is None:
+                    return False
+                if _ready(*_inspect_state(container)):
+                    return True
+                # событие было, но контейнер уже не в нужном состоянии — досматриваем опросом
         time.sleep(min(1.0, poll_every))  # короткая пауза, чтобы Docker успел сменить состояние
         while time.time() < deadline:
-            running, health = _inspect_state(container)
-            if running and (not wait_healthy or health == "healthy"):
-                logger.info({"event": "docker_up", "container": container, "health": health})
+            if _ready(*_inspect_state(container)):
                 return True
             time.sleep(poll_every)
         return False
@@ -212,16 +445,18 @@ def docker_restart(
         "wait_healthy": wait_healthy,
         "up_timeout": up_timeout
     })
+    since = time.time()
     run(["docker", "restart", container], timeout=timeout)
 
     if wait_up:
-        if _wait():
+        if _wait(since):
             logger.info({"event": "docker_restart_ok", "container": container, "t": round(time.monotonic() - t0, 2)})
             return
         if retry_once:
             logger.warning({"event": "docker_restart_retry", "container": container})
+            since = time.time()
             run(["docker", "restart", container], timeout=timeout)
-            if _wait():
+            if _wait(since):
                 logger.info({"event": "docker_restart_ok2", "container": container, "t": round(time.monotonic() - t0, 2)})
                 return
         logger.error({